@@ -0,0 +1,36 @@
+import argparse
+from pathlib import Path
+from longitudinal import STORE_DIR, build_store
+from utilities import OUTPUT_DIR, match_input_files
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--store_dir",
+        dest="store_dir",
+        type=Path,
+        default=STORE_DIR,
+        help="Directory to write the longitudinal store to",
+    )
+
+    return parser.parse_args()
+
+
+def main():
+    """Folds the joined monthly cohort extracts into the longitudinal store (see
+    longitudinal.py)."""
+    args = parse_args()
+
+    files = [
+        file
+        for file in sorted((OUTPUT_DIR / "joined").iterdir())
+        if match_input_files(file.name)
+    ]
+
+    build_store(files, args.store_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,30 +1,20 @@
 import pandas as pd
 import numpy as np
 from variables import tests
-from utilities import (
-    OUTPUT_DIR,
-    cockcroft_gault,
-    ckd_epi
-)
+from utilities import OUTPUT_DIR
+from calculators import evaluate_calculators
 
 
 df = pd.read_csv((OUTPUT_DIR) / "input_calculators.csv.gz", parse_dates=["weight_numeric_value_date", "creatinine_numeric_value_date"])
 
-def apply_cg(row):
-
-    cg = cockcroft_gault(row["sex"], row["age"], row["weight_numeric_value"], row["weight_numeric_value_date"],row["creatinine_numeric_value"], row["creatinine_numeric_value_date"], "2022-04-01")
-    row["cg"] = cg
-    return row
-df = df.apply(apply_cg, axis=1)
-
-
-def apply_ckd_epi(row):
-
-    ckd = ckd_epi(row["sex"], row["age"],row["creatinine_numeric_value"], row["creatinine_numeric_value_date"], "2022-04-01")
-    row["ckd_epi"] = ckd
-    return row
+# the recorded calculators, then the standard eGFR equations and their CKD G category
+calculated = evaluate_calculators(
+    df,
+    ["cg", "ckd_epi", "ckd_epi_2009", "ckd_epi_2021", "mdrd"],
+    date_lim="2022-04-01",
+)
+df = pd.concat([df, calculated], axis=1)
 
-df = df.apply(apply_ckd_epi, axis=1)
 df.to_csv(OUTPUT_DIR / "input_calculators_calculated.csv.gz", index=False)
 
 
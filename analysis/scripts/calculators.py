@@ -0,0 +1,222 @@
+"""Registry of the kidney function calculators (eGFR and creatinine clearance).
+
+Each calculator declares the extract columns it needs. evaluate_calculators computes
+any number of them in one pass over an extract, sharing the intermediate arrays
+(age, sex masks, creatinine in mg/dL, ...) between them, and adds the CKD G category
+of each eGFR.
+"""
+from collections import namedtuple
+from functools import cached_property
+
+import numpy as np
+import pandas as pd
+from utilities import ckd_epi_series, cockcroft_gault_series
+
+# mg/dL of creatinine per µmol/L
+CREATININE_MG_DL = 0.01131
+
+# lower eGFR bounds (mL/min/1.73m2) of the CKD G categories
+G_CATEGORY_BINS = [-np.inf, 15, 30, 45, 60, 90, np.inf]
+G_CATEGORIES = ["G5", "G4", "G3b", "G3a", "G2", "G1"]
+
+Calculator = namedtuple("Calculator", ["name", "columns", "formula", "egfr"])
+
+CALCULATORS = {}
+
+
+def register(name, columns, egfr=True):
+    """Registers a calculator formula.
+    Args:
+        name: Name of the calculator, used as the name of its output column.
+        columns: Extract columns the calculator needs.
+        egfr: Whether the calculator gives an eGFR, which is then staged.
+    Returns:
+        A decorator registering a function of a CalculatorInputs.
+    """
+
+    def decorator(formula):
+        CALCULATORS[name] = Calculator(name, list(columns), formula, egfr)
+        return formula
+
+    return decorator
+
+
+class CalculatorInputs:
+    """Intermediate arrays shared by the calculators, each computed once."""
+
+    def __init__(self, df, date_lim=None):
+        self.df = df
+        self.date_lim = date_lim
+
+    @property
+    def legacy_date_lim(self):
+        # the utilities calculators always apply a date window; a date before
+        # any measurement keeps every measurement with a date
+        if self.date_lim is None:
+            return pd.Timestamp.min
+        return self.date_lim
+
+    @cached_property
+    def age(self):
+        return self.df["age"].to_numpy(dtype=float)
+
+    @cached_property
+    def female(self):
+        return (self.df["sex"] == "F").to_numpy()
+
+    @cached_property
+    def male(self):
+        return (self.df["sex"] == "M").to_numpy()
+
+    @cached_property
+    def creatinine_mg_dl(self):
+        """Creatinine in mg/dL, missing if it is not positive or, given date_lim,
+        not recorded after it"""
+        creatinine = self.df["creatinine_numeric_value"].to_numpy(dtype=float)
+        valid = creatinine > 0
+        if self.date_lim is not None:
+            valid &= (
+                pd.to_datetime(self.date_lim) < self.df["creatinine_numeric_value_date"]
+            ).to_numpy()
+        return np.where(valid, creatinine * CREATININE_MG_DL, np.nan)
+
+    def ckd_epi_equation(
+        self, multiplier, kappa, alpha, exponent, age_base, female_factor
+    ):
+        """The CKD-EPI equation, missing unless sex is "F" or "M"."""
+        kappa = np.where(self.female, kappa[0], kappa[1])
+        alpha = np.where(self.female, alpha[0], alpha[1])
+        ratio = self.creatinine_mg_dl / kappa
+        egfr = (
+            multiplier
+            * np.minimum(ratio, 1) ** alpha
+            * np.maximum(ratio, 1) ** exponent
+            * age_base**self.age
+            * np.where(self.female, female_factor, 1)
+        )
+        return np.where(self.female | self.male, egfr, np.nan)
+
+
+@register(
+    "cg",
+    [
+        "sex",
+        "age",
+        "weight_numeric_value",
+        "weight_numeric_value_date",
+        "creatinine_numeric_value",
+        "creatinine_numeric_value_date",
+    ],
+    egfr=False,
+)
+def cg(inputs):
+    """Cockcroft-Gault, as utilities.cockcroft_gault (creatinine in µmol/L)"""
+    df = inputs.df
+    return cockcroft_gault_series(
+        df["sex"],
+        df["age"],
+        df["weight_numeric_value"],
+        df["weight_numeric_value_date"],
+        df["creatinine_numeric_value"],
+        df["creatinine_numeric_value_date"],
+        inputs.legacy_date_lim,
+    )
+
+
+@register(
+    "ckd_epi",
+    ["sex", "age", "creatinine_numeric_value", "creatinine_numeric_value_date"],
+    egfr=False,
+)
+def ckd_epi(inputs):
+    """CKD-EPI, as utilities.ckd_epi"""
+    df = inputs.df
+    return ckd_epi_series(
+        df["sex"],
+        df["age"],
+        df["creatinine_numeric_value"],
+        df["creatinine_numeric_value_date"],
+        inputs.legacy_date_lim,
+    )
+
+
+@register("ckd_epi_2009", ["sex", "age", "creatinine_numeric_value"])
+def ckd_epi_2009(inputs):
+    """CKD-EPI 2009 eGFR (mL/min/1.73m2), without the race coefficient"""
+    return inputs.ckd_epi_equation(
+        141, (0.7, 0.9), (-0.329, -0.411), -1.209, 0.993, 1.018
+    )
+
+
+@register("ckd_epi_2021", ["sex", "age", "creatinine_numeric_value"])
+def ckd_epi_2021(inputs):
+    """CKD-EPI 2021 eGFR (mL/min/1.73m2)"""
+    return inputs.ckd_epi_equation(
+        142, (0.7, 0.9), (-0.241, -0.302), -1.200, 0.9938, 1.012
+    )
+
+
+@register("mdrd", ["sex", "age", "creatinine_numeric_value"])
+def mdrd(inputs):
+    """IDMS-traceable 4-variable MDRD eGFR (mL/min/1.73m2), without the race
+    coefficient"""
+    egfr = (
+        175
+        * inputs.creatinine_mg_dl**-1.154
+        * inputs.age**-0.203
+        * np.where(inputs.female, 0.742, 1)
+    )
+    return np.where(inputs.female | inputs.male, egfr, np.nan)
+
+
+@register("schwartz", ["height_numeric_value", "creatinine_numeric_value"])
+def schwartz(inputs):
+    """Bedside Schwartz eGFR (mL/min/1.73m2) for children, height in cm"""
+    height = inputs.df["height_numeric_value"].to_numpy(dtype=float)
+    return 0.413 * height / inputs.creatinine_mg_dl
+
+
+def get_g_category(egfr):
+    """Gets the CKD G category (G1 to G5) of each eGFR, missing if it is missing"""
+    return pd.cut(egfr, G_CATEGORY_BINS, right=False, labels=G_CATEGORIES)
+
+
+def evaluate_calculators(df, names=None, date_lim=None):
+    """Computes calculators for each patient of an extract.
+    Args:
+        df: Extract with the columns needed by the calculators.
+        names: Names of the registered calculators to compute. Defaults to all of
+            those whose columns are in df.
+        date_lim: If given, creatinine (and for cg, weight) measurements on or
+            before this date are not used, and df needs the
+            creatinine_numeric_value_date column.
+    Returns:
+        A DataFrame with the index of df, a column for each calculator and a
+        `{name}_g_category` column for each eGFR calculator.
+    Raises:
+        ValueError: If a calculator needs a column that is not in df.
+    """
+    if names is None:
+        names = [
+            name
+            for name, calculator in CALCULATORS.items()
+            if set(calculator.columns) <= set(df.columns)
+        ]
+
+    for name in names:
+        columns = CALCULATORS[name].columns
+        if date_lim is not None:
+            columns = columns + ["creatinine_numeric_value_date"]
+        missing = [column for column in columns if column not in df]
+        if missing:
+            raise ValueError(f"Calculator {name} needs the columns {missing}")
+
+    inputs = CalculatorInputs(df, date_lim)
+    calculated = {}
+    for name in names:
+        calculator = CALCULATORS[name]
+        calculated[name] = pd.Series(calculator.formula(inputs), index=df.index)
+        if calculator.egfr:
+            calculated[f"{name}_g_category"] = get_g_category(calculated[name])
+
+    return pd.DataFrame(calculated, index=df.index)
@@ -1,10 +1,10 @@
 import pandas as pd
 from pathlib import Path
-from utilities import OUTPUT_DIR
-from redaction_utils import drop_and_round
+from utilities import OUTPUT_DIR, read_extract
+from redaction_utils import ZERO_LOW_COUNTS, redact
 
 # Read the data
-df = pd.read_csv(
+df = read_extract(
     OUTPUT_DIR / "joined/input_2023-07-01.csv.gz",
     usecols=[
         "ckd_primis_stage",
@@ -12,15 +12,10 @@ df = pd.read_csv(
         "latest_rrt_status",
         "ckd_acr_category"
     ],
-    dtype={
-        "ckd_primis_stage": "str",
-        "ckd_egfr_category": "str",
-        "latest_rrt_status": "str",
-    },
 )
 
-# Fill missing values
-df = df.fillna("Missing")
+# Use the category labels, filling missing values
+df = df.astype(str).where(df.notnull(), "Missing")
 
 # Drop anyone with stage 1 or 2 who dont have stage A2 or A3 for ACR results. set their egfr_category to Uncategorised
 df.loc[
@@ -41,7 +36,7 @@ counts = df.groupby(
     ["ckd_primis_stage", "ckd_egfr_category", "latest_rrt_status"]
 ).size()
 
-counts = drop_and_round(counts)
+counts, _ = redact(counts, ZERO_LOW_COUNTS)
 
 # rename the columns
 counts = counts.reset_index().rename(columns={0: "count"})
@@ -1,42 +1,37 @@
+import argparse
 import pandas as pd
 import numpy as np
+from functools import lru_cache, partial
 from pathlib import Path
 from variables import tests_extended
 from utilities import (
     OUTPUT_DIR,
+    cached_partial,
+    iter_extract,
     match_input_files,
-    get_date_input_file,
-    round_value,
+    parallel_map,
+)
+from redaction_utils import (
+    GROUP_LOW_COUNTS,
+    REMOVE_LOW_COUNTS,
+    ZERO_LOW_COUNTS,
+    redact,
 )
-from redaction_utils import group_low_values_series, drop_and_round
-
-
-Path(OUTPUT_DIR / f"pub/operator_counts").mkdir(parents=True, exist_ok=True)
-
-
-# 1. A count of each code
-code_counts = {}
-
-# 2. A count of each code with associated numeric value
-numeric_value_counts = {}
-
-
-# 3. A count of each operator
-operator_counts = {}
-
-
-# 4. A count of each numeric value-operator pair
-numeric_value_operator_counts = {}
 
 
-for test in tests_extended:
-    code_counts[test] = []
-    numeric_value_counts[test] = []
-    operator_counts[test] = []
-    numeric_value_operator_counts[test] = {}
+OPERATORS = ["<", ">", "<=", ">=", "=", "missing"]
 
-    for operator in ["<", ">", "<=", ">=", "=", "missing"]:
-        numeric_value_operator_counts[test][operator] = []
+# the count families computed for every test:
+# 1. a count of each code
+# 2. a count of each code with associated numeric value
+# 3. a count of each operator
+# 4. a count of each numeric value-operator pair
+COUNT_FAMILIES = [
+    "code",
+    "code_with_numeric_value",
+    "operator",
+    "numeric_value_operator",
+]
 
 
 numeric_value_mappings = {
@@ -116,178 +111,289 @@ numeric_value_mappings = {
 }
 
 
+@lru_cache(maxsize=None)
+def compile_mapping(bins):
+    """Compiles numeric value bins into arrays of bin edges sorted by lower edge.
+    Args:
+        bins: A tuple of ((lower, upper), mapped_value) pairs, e.g.
+            tuple(numeric_value_mappings["eGFR"].items()).
+    Returns:
+        A tuple of (lower, upper, mapped) arrays.
+    """
+    bins = sorted(bins)
+    lower = np.array([lower for (lower, _), _ in bins], dtype=float)
+    upper = np.array([upper for (_, upper), _ in bins], dtype=float)
+    mapped = np.array([mapped_value for _, mapped_value in bins], dtype=float)
+
+    if (lower[1:] < upper[:-1]).any():
+        raise ValueError("Numeric value bins must not overlap")
+
+    return lower, upper, mapped
+
+
 def map_numeric_values(series, mapping):
-    conditions = [
-        series.between(lower, upper, inclusive="left")
-        for (lower, upper), _ in mapping.items()
-    ]
-    choices = [mapped_value for _, mapped_value in mapping.items()]
+    """Maps each value in [lower, upper) of a bin to the bin's mapped value. Values
+    outside every bin, and missing values, are left unchanged.
+    """
+    lower, upper, mapped = compile_mapping(tuple(mapping.items()))
+    values = np.asarray(series, dtype=float)
+
+    # index of the bin with the largest lower edge <= value
+    bin_index = np.searchsorted(lower, values, side="right") - 1
+    in_bin = bin_index >= 0
+    in_bin[in_bin] = values[in_bin] < upper[bin_index[in_bin]]
 
-    return np.select(conditions, choices, default=series)
+    result = values.copy()
+    result[in_bin] = mapped[bin_index[in_bin]]
+
+    if np.isnan(result).any():
+        return result
+    return result.astype(int)
 
 
 def convert_values(df, test, mapping):
-    df.loc[df[f"{test}_numeric_value"] < 0, f"{test}_numeric_value"] = -1
+    values = np.asarray(df[f"{test}_numeric_value"], dtype=float)
 
-    df.loc[
-        (df[f"{test}_numeric_value"] > 0) & (df[f"{test}_numeric_value"] < 1),
-        f"{test}_numeric_value",
-    ] = 1
+    # convert any negative values to -1, any values between 0 and 1 to 1
+    # and round anything else to the nearest integer (half to even, as round())
+    values = np.where(values < 0, -1, values)
+    values = np.where((values > 0) & (values < 1), 1, values)
+    values = np.round(values)
+
+    df[f"{test}_numeric_value"] = map_numeric_values(values, mapping[test])
+    return df
 
-    df[f"{test}_numeric_value"] = df[f"{test}_numeric_value"].apply(
-        lambda x: round_value(x)
-    )
 
+def get_test_columns(tests):
+    """Returns the code, numeric value and operator columns needed for each test."""
+    return [
+        f"{test}_{column}"
+        for test in tests
+        for column in ["code", "numeric_value", "operator"]
+    ]
+
+
+def stack_tests(df, tests, mapping):
+    """Stacks the code, numeric value and operator columns of each test into a single
+    long table with a `test` column, so that all tests can be counted together.
+    Args:
+        df: A cohort extract containing the columns from `get_test_columns`.
+        tests: The tests to stack.
+        mapping: Numeric value mappings used to bin the numeric values.
+    Returns:
+        A table with `test`, `code`, `numeric_value`, `operator`, `has_numeric_value`
+        and `numeric_value_bin` columns.
+    """
+    frames = []
+    for test in tests:
+        # codes and operators are categoricals with different categories for each
+        # test, so are stacked as plain values
+        frame = pd.DataFrame(
+            {
+                "test": test,
+                "code": df[f"{test}_code"].astype(object),
+                "numeric_value": df[f"{test}_numeric_value"],
+                "operator": df[f"{test}_operator"].astype(object).fillna("missing"),
+            }
+        )
 
-    df[f"{test}_numeric_value"] = map_numeric_values(
-        df[f"{test}_numeric_value"], mapping[test]
+        # numeric value >0 OR numeric value is 0 but operator is not missing
+        frame["has_numeric_value"] = (frame["numeric_value"] > 0) | (
+            (frame["numeric_value"] == 0) & (frame["operator"] != "missing")
+        )
+
+        # convert any negative values to -1, any values exactly 0 remain as 0,
+        # any values between 0 and 1 are rounded to 1, then bin
+        binned = convert_values(
+            df.loc[frame["has_numeric_value"], [f"{test}_numeric_value"]].copy(),
+            test,
+            mapping,
+        )
+        frame["numeric_value_bin"] = binned[f"{test}_numeric_value"]
+
+        frames.append(frame)
+
+    return pd.concat(frames, ignore_index=True)
+
+
+def count_tests(df, tests, mapping):
+    """Computes the partial counts of every count family for all tests in a
+    cohort extract.
+    Args:
+        df: A cohort extract containing the columns from `get_test_columns`.
+        tests: The tests to count.
+        mapping: Numeric value mappings used to bin the numeric values.
+    Returns:
+        A dict of count Series keyed by count family. Each Series is indexed by
+        `test` and the counted column(s).
+    """
+    stacked = stack_tests(df, tests, mapping)
+    with_numeric_value = stacked.loc[stacked["has_numeric_value"], :]
+
+    # operators other than those listed (e.g. "~") are not counted as pairs
+    pairs = with_numeric_value.loc[with_numeric_value["operator"].isin(OPERATORS), :]
+
+    return {
+        "code": stacked.groupby(["test", "code"], sort=False).size(),
+        "code_with_numeric_value": with_numeric_value.groupby(
+            ["test", "code"], sort=False
+        ).size(),
+        "operator": with_numeric_value.groupby(["test", "operator"], sort=False).size(),
+        "numeric_value_operator": pairs.astype({"numeric_value_bin": int})
+        .groupby(["test", "numeric_value_bin", "operator"], sort=False)
+        .size(),
+    }
+
+
+def count_file(path, tests, mapping):
+    """Reads only the test columns of a cohort extract, in chunks, and counts them.
+    Codes and operators are ordered by count (ties by code or operator), as
+    value_counts() orders them, so that once the extracts are combined, they are
+    listed in the order they are first seen."""
+    counts = combine_counts(
+        [
+            count_tests(chunk, tests, mapping)
+            for chunk in iter_extract(path, usecols=get_test_columns(tests))
+        ]
     )
-    return df
+    for family in ["code", "code_with_numeric_value", "operator"]:
+        counts[family] = (
+            counts[family].sort_index().sort_values(ascending=False, kind="stable")
+        )
+    return counts
+
+
+def combine_counts(partial_counts):
+    """Sums partial counts (e.g. one per month) of each count family."""
+    combined = {}
+    for family in COUNT_FAMILIES:
+        counts = pd.concat([partial[family] for partial in partial_counts])
+        combined[family] = counts.groupby(
+            level=list(range(counts.index.nlevels)), sort=False
+        ).sum()
+    return combined
 
 
-for file in (OUTPUT_DIR / "joined").iterdir():
-    if match_input_files(file.name):
-        df = pd.read_csv((OUTPUT_DIR / "joined") / file.name)
-
-        date = get_date_input_file(file.name)
-
-        for test in tests_extended:
-            df[f"{test}_operator"].fillna("missing", inplace=True)
-
-            # 1 A count of each code
-            code_counts[test].append(df[f"{test}_code"].value_counts())
-
-            # subset with a numeric value >0 OR where numeric value is 0 but operator is not missing
-            df_subset_with_numeric_value = df.loc[
-                (
-                    (df[f"{test}_numeric_value"].notnull())
-                    & (df[f"{test}_numeric_value"] > 0)
-                )
-                | (
-                    (df[f"{test}_numeric_value"] == 0)
-                    & (df[f"{test}_operator"] != "missing")
-                ),
-                :,
-            ]
-
-            # 2. A count of each code with associated numeric value
-            numeric_value_counts[test].append(
-                df_subset_with_numeric_value.loc[
-                    :,
-                    f"{test}_code",
-                ].value_counts()
-            )
-
-            # 3. A count of each operator
-            operator_counts[test].append(
-                df_subset_with_numeric_value[f"{test}_operator"].value_counts()
-            )
-
-            # 4. A count of each numeric value-operator pair
-
-            # convert any negative values to -1, any values exactly 0 remain as 0, any values between 0 and 1 are rounded to 1
-
-            convert_values(df_subset_with_numeric_value, test, numeric_value_mappings)
-
-            # replace missing and ~ with =
-            # df_subset_with_numeric_value[f"{test}_operator"].replace(
-            #     "missing", "=", inplace=True
-            # )
-            df_subset_with_numeric_value[f"{test}_operator"].replace(
-                "~", "=", inplace=True
-            )
-
-            for operator in ["<", ">", "<=", ">=", "=", "missing"]:
-                subset = df_subset_with_numeric_value.loc[
-                    df[f"{test}_operator"] == operator,
-                    [f"{test}_numeric_value", f"{test}_operator"],
-                ]
-
-                numeric_value_operator_counts[test][operator].append(
-                    subset.groupby([f"{test}_numeric_value", f"{test}_operator"]).size()
-                )
-
-for test in tests_extended:
+def get_test_counts(counts, test):
+    """Selects the counts for a single test, dropping the `test` index level."""
+    return counts[counts.index.get_level_values("test") == test].droplevel("test")
+
+
+def write_test_counts(counts, test, output_dir):
+    # codes and operators are in the order they are first seen, most common first
+    # in each extract
+
     # 1 A count of each code
-    test_codes = pd.concat(code_counts[test], axis=1, sort=False).sum(axis=1)
-    test_codes = group_low_values_series(test_codes)
+    test_codes = get_test_counts(counts["code"], test)
+    test_codes, _ = redact(test_codes, GROUP_LOW_COUNTS)
     test_codes.rename("count", inplace=True)
+    test_codes.index.name = "code"
     test_codes = test_codes.reset_index()
-    test_codes.rename(columns={"index": "code"}, inplace=True)
-
-    test_codes["count"] = drop_and_round(test_codes["count"])
 
-    test_codes.to_csv(
-        OUTPUT_DIR / f"pub/operator_counts/{test}_codes_count.csv", index=False
-    )
+    test_codes.to_csv(output_dir / f"{test}_codes_count.csv", index=False)
 
     # 2. A count of each code with associated numeric value
-    test_codes_with_numeric_value = pd.concat(
-        numeric_value_counts[test], axis=1, sort=False
-    ).sum(axis=1)
-    test_codes_with_numeric_value = group_low_values_series(
-        test_codes_with_numeric_value
+    test_codes_with_numeric_value = get_test_counts(
+        counts["code_with_numeric_value"], test
+    )
+    test_codes_with_numeric_value, _ = redact(
+        test_codes_with_numeric_value, GROUP_LOW_COUNTS
     )
     test_codes_with_numeric_value.rename("count", inplace=True)
+    test_codes_with_numeric_value.index.name = "code"
     test_codes_with_numeric_value = test_codes_with_numeric_value.reset_index()
-    test_codes_with_numeric_value.rename(columns={"index": "code"}, inplace=True)
-    test_codes_with_numeric_value["count"] = drop_and_round(
-        test_codes_with_numeric_value["count"]
-    )
     test_codes_with_numeric_value.to_csv(
-        OUTPUT_DIR / f"pub/operator_counts/{test}_codes_with_numeric_value_count.csv",
+        output_dir / f"{test}_codes_with_numeric_value_count.csv",
         index=False,
     )
 
     # 3. A count of each operator
+    test_operators = get_test_counts(counts["operator"], test)
+    test_operators.index.name = None
 
-    test_operators = pd.concat(operator_counts[test], axis=1, sort=False).sum(axis=1)
-   
-    drop_and_round(test_operators).to_csv(
-        OUTPUT_DIR / f"pub/operator_counts/{test}_operators_count.csv"
-    )
+    test_operators, _ = redact(test_operators, ZERO_LOW_COUNTS)
+    test_operators.to_csv(output_dir / f"{test}_operators_count.csv")
 
     # 4. A count of each numeric value-operator pair
-
-    combined_values = []
-    for operator in ["<", ">", "<=", ">=", "=", "missing"]:
-        operator_combined = pd.concat(
-            numeric_value_operator_counts[test][operator]
-        ).reset_index()
-
-        operator_combined.rename(
-            columns={
-                0: "count",
-            },
-            inplace=True,
-        )
-
-        operator_combined.sort_values(by=f"{test}_numeric_value", inplace=True)
-
-        combined_values.append(operator_combined)
-
-    combined_values = pd.concat(combined_values)
-
-    combined_values = combined_values.groupby(
-        [f"{test}_numeric_value", f"{test}_operator"]
-    ).sum()
+    combined_values = get_test_counts(counts["numeric_value_operator"], test)
+    combined_values.index.names = [f"{test}_numeric_value", f"{test}_operator"]
+    combined_values = combined_values.to_frame("count")
 
     combined_values.sort_values(
         by=[f"{test}_operator", f"{test}_numeric_value"], inplace=True
     )
 
     combined_values.to_csv(
-        OUTPUT_DIR / f"pub/operator_counts/{test}_numeric_value_operator_count.csv",
+        output_dir / f"{test}_numeric_value_operator_count.csv",
         index=True,
     )
 
     # remove any rows where count is <=7
-    combined_values = combined_values[combined_values["count"] > 7]
-    combined_values["count"] = combined_values["count"].apply(round_value, args=(5,))
+    combined_values, _ = redact(
+        combined_values, REMOVE_LOW_COUNTS, columns=["count"]
+    )
 
     combined_values.to_csv(
-        OUTPUT_DIR
-        / f"pub/operator_counts/{test}_numeric_value_operator_count_rounded.csv",
+        output_dir / f"{test}_numeric_value_operator_count_rounded.csv",
         index=True,
     )
 
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--workers",
+        dest="workers",
+        type=int,
+        default=None,
+        help="Number of processes used to count the monthly extracts. "
+        "Defaults to the available cores; 1 counts them in this process",
+    )
+
+    parser.add_argument(
+        "--partials_dir",
+        dest="partials_dir",
+        type=Path,
+        default=None,
+        help="Directory of stored counts of each monthly extract, reused by "
+        "reruns for extracts that haven't changed. The counts are derived from "
+        "patient level data, so are not stored by default",
+    )
+
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    output_dir = OUTPUT_DIR / "pub/operator_counts"
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    files = [
+        file
+        for file in sorted((OUTPUT_DIR / "joined").iterdir())
+        if match_input_files(file.name)
+    ]
+
+    # each month is counted independently; results come back in file order so
+    # the merged counts are identical to counting the months one after another
+    partial_counts = parallel_map(
+        partial(
+            cached_partial,
+            func=count_file,
+            store_dir=args.partials_dir,
+            tests=tests_extended,
+            mapping=numeric_value_mappings,
+        ),
+        files,
+        workers=args.workers,
+    )
+    counts = combine_counts(partial_counts)
+
+    for test in tests_extended:
+        write_test_counts(counts, test, output_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,35 @@
+import argparse
+from utilities import OUTPUT_DIR, match_input_files, parallel_map, write_columnar
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--workers",
+        dest="workers",
+        type=int,
+        default=None,
+        help="Number of processes used to convert the extracts. "
+        "Defaults to the available cores",
+    )
+
+    return parser.parse_args()
+
+
+def main():
+    """Converts each joined cohort extract to a columnar (feather) copy, which
+    read_extract uses in place of the csv."""
+    args = parse_args()
+
+    files = [
+        file
+        for file in sorted((OUTPUT_DIR / "joined").iterdir())
+        if match_input_files(file.name)
+    ]
+
+    parallel_map(write_columnar, files, workers=args.workers)
+
+
+if __name__ == "__main__":
+    main()
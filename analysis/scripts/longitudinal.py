@@ -0,0 +1,184 @@
+"""Patient level longitudinal store of the monthly cohort extracts.
+
+The monthly extracts repeat every patient's variables in every month. The store
+holds them once:
+
+- static.feather: a row per patient, with the months of their first and latest
+  records and the variables that don't depend on the index date (STATIC_COLUMNS),
+  as of their latest record.
+- months.feather: the (patient_id, date) of each record.
+- values/{column}/{date}.feather: for each other variable and month, the
+  (patient_id, date, value) of the records where it has a value. Missing values,
+  and binary flags of 0, are left out. Each month's files are written as its
+  extract is read, so building the store only holds the static table and the
+  months in memory.
+
+read_values rebuilds the records of some variables for all months, reading only
+their files, and latest_values gets each patient's values in their latest month.
+
+The store is a second copy of the patient level data, so it isn't built by an
+action of project.yaml until an action reads it. build_longitudinal_store.py
+builds it.
+"""
+import shutil
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from utilities import OUTPUT_DIR, get_date_input_file, read_extract, update_latest
+
+STORE_DIR = OUTPUT_DIR / "joined/longitudinal"
+
+# variables that don't depend on the index date of the extracts
+STATIC_COLUMNS = [
+    "sex",
+    "ethnicity",
+    "ukrr_2019",
+    "ukrr_2020",
+    "ukrr_2021",
+    "ukrr_ckd2020",
+    "ukrr_ckd2020_creat",
+    "ukrr_ckd2020_egfr",
+]
+
+
+def is_flag(column):
+    """Checks if a column holds binary flags, whose 0s are left out of the store"""
+    return column.dtype == np.uint8
+
+
+def get_values_dir(column, store_dir=STORE_DIR):
+    return Path(store_dir) / "values" / column
+
+
+def concat_values(frames):
+    """Concatenates frames of a variable's values, keeping categories"""
+    df = pd.concat(frames, ignore_index=True)
+    if any(isinstance(frame["value"].dtype, pd.CategoricalDtype) for frame in frames):
+        df["value"] = df["value"].astype("category")
+    return df
+
+
+def build_store(paths, store_dir=STORE_DIR, static_columns=STATIC_COLUMNS):
+    """Builds the longitudinal store from monthly cohort extracts.
+    Args:
+        paths: Paths to the cohort extracts (input_YYYY-MM-DD.csv.gz).
+        store_dir: Directory to write the store to.
+        static_columns: Variables stored once per patient, as of their latest
+            record.
+    Returns:
+        The store directory.
+    """
+    store_dir = Path(store_dir)
+    # values of extracts that are no longer in paths mustn't be left behind
+    shutil.rmtree(store_dir / "values", ignore_errors=True)
+    (store_dir / "values").mkdir(parents=True)
+
+    static = None
+    months = []
+    for path in sorted(paths, key=lambda path: get_date_input_file(Path(path).name)):
+        date = pd.Timestamp(get_date_input_file(Path(path).name))
+        df = read_extract(path)
+
+        static_df = df[["patient_id"] + [c for c in static_columns if c in df]]
+        static_df = static_df.assign(last_date=date)
+        if static is not None:
+            # the first month of patients already in the store
+            first_dates = static.set_index("patient_id")["first_date"]
+            static_df = static_df.assign(
+                first_date=static_df["patient_id"].map(first_dates).fillna(date)
+            )
+        else:
+            static_df = static_df.assign(first_date=date)
+        static = update_latest(static, static_df)
+
+        months.append(pd.DataFrame({"patient_id": df["patient_id"], "date": date}))
+
+        for column in df.columns:
+            if column == "patient_id" or column in static_columns:
+                continue
+            present = df[column].notnull()
+            if is_flag(df[column]):
+                present &= df[column] != 0
+            values_dir = get_values_dir(column, store_dir)
+            values_dir.mkdir(exist_ok=True)
+            pd.DataFrame(
+                {
+                    "patient_id": df.loc[present, "patient_id"],
+                    "date": date,
+                    "value": df.loc[present, column],
+                }
+            ).reset_index(drop=True).to_feather(
+                values_dir / f"{date.date()}.feather", compression="zstd"
+            )
+
+    static = static.sort_values("patient_id", ignore_index=True)
+    static["first_date"] = pd.to_datetime(static["first_date"])
+    static.to_feather(store_dir / "static.feather", compression="zstd")
+    pd.concat(months, ignore_index=True).to_feather(
+        store_dir / "months.feather", compression="zstd"
+    )
+
+    return store_dir
+
+
+def read_static(columns=None, store_dir=STORE_DIR):
+    """Reads the static table: a row per patient, with first_date, last_date and
+    the static variables (or those of columns)."""
+    if columns is not None:
+        columns = ["patient_id", "first_date", "last_date"] + list(columns)
+    return pd.read_feather(Path(store_dir) / "static.feather", columns=columns)
+
+
+def lookup_values(column, index, store_dir=STORE_DIR):
+    """Looks up the values of a month-varying variable for (patient_id, date) pairs,
+    missing (or 0, for binary flags) where the store has no value."""
+    values = concat_values(
+        [
+            pd.read_feather(path)
+            for path in sorted(get_values_dir(column, store_dir).glob("*.feather"))
+        ]
+    )
+    values = values.set_index(["patient_id", "date"])["value"]
+    if is_flag(values):
+        return values.reindex(index, fill_value=0).to_numpy()
+    return values.reindex(index).to_numpy()
+
+
+def read_values(columns, store_dir=STORE_DIR):
+    """Reads the values of some month-varying variables in every month.
+    Args:
+        columns: The variables to read.
+        store_dir: Directory of the store.
+    Returns:
+        A data frame with a row per record (patient_id, date) and a column per
+        variable.
+    """
+    df = pd.read_feather(Path(store_dir) / "months.feather")
+    index = pd.MultiIndex.from_frame(df)
+
+    for column in columns:
+        df[column] = lookup_values(column, index, store_dir)
+
+    return df
+
+
+def latest_values(columns, store_dir=STORE_DIR):
+    """Gets the values of some variables in each patient's latest record.
+    Args:
+        columns: Static or month-varying variables.
+        store_dir: Directory of the store.
+    Returns:
+        A data frame indexed by patient_id, with a column per variable.
+    """
+    static = read_static(store_dir=store_dir).set_index("patient_id")
+    index = pd.MultiIndex.from_arrays([static.index, static["last_date"]])
+
+    df = pd.DataFrame(index=static.index)
+    for column in columns:
+        if column in static:
+            df[column] = static[column]
+        else:
+            df[column] = lookup_values(column, index, store_dir)
+
+    return df
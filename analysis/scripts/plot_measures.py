@@ -1,334 +1,339 @@
 import pandas as pd
 import numpy as np
+from functools import partial
 from pathlib import Path
 from utilities import *
-from redaction_utils import compute_deciles, redact_small_numbers, round_column
+from redaction_utils import SUPPRESS_LOW_COUNTS, compute_deciles, redact
+from rounding import round_column
 from variables import tests_extended
 import matplotlib.dates as mdates
 
 
-Path.mkdir(OUTPUT_DIR / "pub.deciles", parents=True, exist_ok=True)
-Path.mkdir(OUTPUT_DIR / "pub/deciles/data", parents=True, exist_ok=True)
-Path.mkdir(OUTPUT_DIR / "pub/deciles/figures", parents=True, exist_ok=True)
-Path.mkdir(OUTPUT_DIR / "pub/tests_by_ckd_stage", parents=True, exist_ok=True)
-Path.mkdir(OUTPUT_DIR / "pub/ukrr_testing", parents=True, exist_ok=True)
-
-# 1. for each test, plot deciles charts in total population and at risk population
-for i in [
-    "creatinine",
-    "eGFR",
-    "albumin",
-    "acr",
-    "cr_cl",
-]:
-    for j in ["population", "at_risk"]:
-        df = pd.read_csv(
-            OUTPUT_DIR / f"joined/measure_{i}_{j}_rate.csv", parse_dates=["date"]
-        )
-
-        df = drop_irrelevant_practices(df)
-
-        dfs = {}
-
-        dfs["all"] = df
-
-        for k, df in dfs.items():
-            df = df.replace(np.inf, np.nan)
-
-            df_deciles = compute_deciles(df, "date", i)
-
-            deciles_chart(
-                df,
-                filename=f"output/pub/deciles/figures/plot_{i}_{j}_{k}.jpeg",
-                data_filename=f"output/pub/deciles/data/plot_{i}_{j}_{k}_deciles.csv",
-                period_column="date",
-                column="value",
-                count_column=i,
-                ylabel="Proportion",
-            )
-
-
-# 2. ckd by stage
-
-df_ckd_stage = pd.read_csv(
-    OUTPUT_DIR / "joined/input_2023-07-01.csv.gz",
-    usecols=[
-        "ckd_primis_1_5",
-        "ckd_primis_stage",
-    ],
-)
-
-df_ckd_stage = df_ckd_stage.loc[df_ckd_stage["ckd_primis_1_5"] == 1, :]
-
-ckd_stage = df_ckd_stage["ckd_primis_stage"]
-
-ckd_stage_count = ckd_stage.value_counts()
-ckd_stage_count.rename("count", inplace=True)
-
-ckd_stage_count = ckd_stage_count.apply(lambda x: round(x / 5) * 5)
-
-ckd_proportion = ckd_stage_count / ckd_stage_count.sum()
-ckd_proportion.rename("proportion", inplace=True)
-
-
-df_ckd_stage = pd.concat([ckd_stage_count, ckd_proportion], axis=1)
-df_ckd_stage = df_ckd_stage.reset_index()
-df_ckd_stage.rename(columns={"index": "ckd_primis_stage"}, inplace=True)
-
-Path.mkdir(OUTPUT_DIR / "pub/ckd_stage", parents=True, exist_ok=True)
-
-df_ckd_stage.to_csv(OUTPUT_DIR / f"pub/ckd_stage/plot_ckd_stage.csv", index=False)
-
-plt.figure(figsize=(12, 8))
-plt.bar(df_ckd_stage["ckd_primis_stage"], df_ckd_stage["proportion"] * 100)
-plt.xlabel("CKD stage (recorded)")
-plt.ylabel("Proportion")
-plt.title("CKD stage")
-plt.tight_layout()
-plt.savefig(f"output/pub/ckd_stage/plot_ckd_stage.jpeg")
-
+def draw_ckd_stage(fig, df_ckd_stage):
+    ax = fig.add_subplot()
+    ax.bar(df_ckd_stage["ckd_primis_stage"], df_ckd_stage["proportion"] * 100)
+    ax.set_xlabel("CKD stage (recorded)")
+    ax.set_ylabel("Proportion")
+    ax.set_title("CKD stage")
+    fig.tight_layout()
 
-# 3. testing rate by ckd stage
-for test in tests_extended:
-    print(f"TEST: {test}")
 
-    # single reduced egfr
-    df = pd.read_csv(
-        OUTPUT_DIR / f"joined/measure_{test}_single_egfr_population_rate.csv",
-        parse_dates=["date"],
+def draw_single_biochem_stage(fig, single_egfr, primis_stage, ckd_stage, x_labels):
+    ax = fig.add_subplot()
+    ax.plot(
+        single_egfr["date"],
+        single_egfr["value"],
+        label="Single reduced eGFR",
+        color="red",
+    )
+    ax.plot(
+        primis_stage["date"],
+        primis_stage["value"],
+        label="CKD stage (recorded)",
+        color="blue",
+    )
+    ax.plot(
+        ckd_stage["date"],
+        ckd_stage["value"],
+        label="CKD stage (biochemical)",
+        color="green",
     )
 
-    df = df.loc[df["single_egfr"] == 1, :]
-    redact_small_numbers(df, 7, 5, test, "population", "value", "date")
+    ax.set_xticks(x_labels)
+    ax.set_xticklabels(x_labels, rotation="vertical")
+    ax.xaxis.set_major_formatter(mdates.DateFormatter("%Y-%m-%d"))
+    ax.set_ylabel("Proportion")
+    ax.set_xlabel("Date")
+    ax.margins(x=0)
+    ax.grid(True)
 
-    plot_measures(
-        df=df,
-        filename=f"plot_single_reduced_egfr_{test}",
-        title=f"",
-        column_to_plot="value",
-        y_label="Proportion",
-        as_bar=False,
-    )
+    ax.legend(bbox_to_anchor=(1.04, 1), loc="upper left")
+    fig.tight_layout()
 
-    df_ckd_stage = pd.read_csv(
-        OUTPUT_DIR / f"joined/measure_{test}_biochemical_stage_population_rate.csv",
-        parse_dates=["date"],
-    )
 
-    df_ckd_stage_egfr = (
-        df_ckd_stage.groupby(by=["ckd_egfr_category", "date"])[[test, "population"]]
+def sum_biochemical_stages(df, test):
+    """Sums the test and population counts of the biochemical stage measure by eGFR
+    category, by ACR category and, for eGFR categories G3a to G5, by date alone.
+    The G3a to G5 sums are taken from the eGFR category sums.
+    """
+    columns = [test, "population"]
+
+    by_egfr = (
+        df.groupby(by=["ckd_egfr_category", "date"], observed=True)[columns]
         .sum()
         .reset_index()
     )
-    df_ckd_stage_egfr["value"] = (
-        df_ckd_stage_egfr[test] / df_ckd_stage_egfr["population"]
+    by_acr = (
+        df.groupby(by=["ckd_acr_category", "date"], observed=True)[columns]
+        .sum()
+        .reset_index()
     )
+    g3_to_g5 = by_egfr.loc[
+        by_egfr["ckd_egfr_category"].isin(["G3a", "G3b", "G4", "G5"]), :
+    ]
+    g3_to_g5 = g3_to_g5.groupby(by=["date"])[columns].sum().reset_index()
+
+    return by_egfr, by_acr, g3_to_g5
+
+
+def main():
+    Path.mkdir(OUTPUT_DIR / "pub.deciles", parents=True, exist_ok=True)
+    Path.mkdir(OUTPUT_DIR / "pub/deciles/data", parents=True, exist_ok=True)
+    Path.mkdir(OUTPUT_DIR / "pub/deciles/figures", parents=True, exist_ok=True)
+    Path.mkdir(OUTPUT_DIR / "pub/tests_by_ckd_stage", parents=True, exist_ok=True)
+    Path.mkdir(OUTPUT_DIR / "pub/ukrr_testing", parents=True, exist_ok=True)
+
+    # figures are queued as they are specified and rendered together at the end
+    figures = []
+
+    # 1. for each test, plot deciles charts in total population and at risk population
+    for i in [
+        "creatinine",
+        "eGFR",
+        "albumin",
+        "acr",
+        "cr_cl",
+    ]:
+        for j in ["population", "at_risk"]:
+            df = pd.read_csv(
+                OUTPUT_DIR / f"joined/measure_{i}_{j}_rate.csv", parse_dates=["date"]
+            )
 
-    df_ckd_stage_egfr = df_ckd_stage_egfr.replace(np.inf, np.nan)
-    df_ckd_stage_egfr = redact_small_numbers(
-        df_ckd_stage_egfr, 7, 5, test, "population", "value", "date"
-    )
-    df_ckd_stage_egfr["value"] = (
-        df_ckd_stage_egfr[test] / df_ckd_stage_egfr["population"]
-    )
-    df_ckd_stage_egfr = df_ckd_stage_egfr.drop(
-        [
-            "column",
-        ],
-        axis=1,
-    )
-    df_ckd_stage_egfr.to_csv(
-        f"output/pub/tests_by_ckd_stage/plot_ckd_biochemical_stage_{test}_egfr.csv",
-        index=False,
-    )
+            df = drop_irrelevant_practices(df)
 
-    plot_measures(
-        df=df_ckd_stage_egfr,
-        filename=f"pub/tests_by_ckd_stage/plot_ckd_biochemical_stage_{test}_egfr",
-        title=f"",
-        column_to_plot="value",
-        y_label="Proportion",
-        as_bar=False,
-        category="ckd_egfr_category",
-    )
+            dfs = {}
 
-    df_ckd_stage_acr = (
-        df_ckd_stage.groupby(by=["ckd_acr_category", "date"])[[test, "population"]]
-        .sum()
-        .reset_index()
-    )
+            dfs["all"] = df
 
-    df_ckd_stage_acr["value"] = df_ckd_stage_acr[test] / df_ckd_stage_acr["population"]
+            for k, df in dfs.items():
+                df = df.replace(np.inf, np.nan)
 
-    # df_ckd_stage = df_ckd_stage.replace(np.inf, np.nan)
-    df_ckd_stage_acr = redact_small_numbers(
-        df_ckd_stage_acr, 7, 5, test, "population", "value", "date"
-    )
+                df_deciles = compute_deciles(df, "date", i)
+
+                deciles_chart(
+                    df,
+                    filename=f"output/pub/deciles/figures/plot_{i}_{j}_{k}.jpeg",
+                    data_filename=f"output/pub/deciles/data/plot_{i}_{j}_{k}_deciles.csv",
+                    period_column="date",
+                    column="value",
+                    count_column=i,
+                    ylabel="Proportion",
+                    queue=figures,
+                )
 
-    df_ckd_stage_acr["value"] = df_ckd_stage_acr[test] / df_ckd_stage_acr["population"]
+    # 2. ckd by stage
 
-    df_ckd_stage_acr = df_ckd_stage_acr.drop(
-        [
-            "column",
+    df_ckd_stage = read_extract(
+        OUTPUT_DIR / "joined/input_2023-07-01.csv.gz",
+        usecols=[
+            "ckd_primis_1_5",
+            "ckd_primis_stage",
         ],
-        axis=1,
     )
 
-    df_ckd_stage_acr.to_csv(
-        f"output/pub/tests_by_ckd_stage/plot_ckd_biochemical_stage_{test}_acr.csv",
-        index=False,
-    )
+    df_ckd_stage = df_ckd_stage.loc[df_ckd_stage["ckd_primis_1_5"] == 1, :]
 
-    plot_measures(
-        df=df_ckd_stage_acr,
-        filename=f"plot_ckd_biochemical_stage_{test}_acr",
-        title=f"",
-        column_to_plot="value",
-        y_label="Proportion",
-        as_bar=False,
-        category="ckd_acr_category",
-    )
+    ckd_stage = df_ckd_stage["ckd_primis_stage"].cat.remove_unused_categories()
 
-    df_recorded_stage = pd.read_csv(
-        OUTPUT_DIR / f"joined/measure_{test}_stage_population_rate.csv",
-        parse_dates=["date"],
-    )
+    # in stage order, so that the bars are plotted in stage order
+    ckd_stage_count = ckd_stage.value_counts().sort_index()
+    ckd_stage_count.rename("count", inplace=True)
 
-    df_recorded_stage = df_recorded_stage.replace(np.inf, np.nan)
+    ckd_stage_count = round_column(ckd_stage_count, 5)
 
-    df_recorded_stage = redact_small_numbers(
-        df_recorded_stage, 7, 5, test, "population", "value", "date"
-    )
+    ckd_proportion = ckd_stage_count / ckd_stage_count.sum()
+    ckd_proportion.rename("proportion", inplace=True)
 
-    df_recorded_stage["value"] = df_recorded_stage[test] / df_recorded_stage["population"]
+    df_ckd_stage = pd.concat([ckd_stage_count, ckd_proportion], axis=1)
+    df_ckd_stage = df_ckd_stage.reset_index()
+    df_ckd_stage.rename(columns={"index": "ckd_primis_stage"}, inplace=True)
 
-    df_recorded_stage = df_recorded_stage.drop(
-        [
-            "column",
-        ],
-        axis=1,
-    )
+    Path.mkdir(OUTPUT_DIR / "pub/ckd_stage", parents=True, exist_ok=True)
 
-    df_recorded_stage.to_csv(
-        f"output/pub/tests_by_ckd_stage/plot_ckd_recorded_stage_{test}.csv",
-        index=False,
-    )
-    plot_measures(
-        df=df_recorded_stage,
-        filename=f"pub/tests_by_ckd_stage/plot_ckd_recorded_stage_{test}",
-        title=f"",
-        column_to_plot="value",
-        y_label="Proportion",
-        as_bar=False,
-        category="ckd_primis_stage",
+    df_ckd_stage.to_csv(OUTPUT_DIR / f"pub/ckd_stage/plot_ckd_stage.csv", index=False)
+
+    figures.append(
+        figure_spec(
+            draw_ckd_stage,
+            "output/pub/ckd_stage/plot_ckd_stage.jpeg",
+            figsize=(12, 8),
+            df_ckd_stage=df_ckd_stage,
+        )
     )
 
+    # 3. testing rate by ckd stage, and
+    # 4. plot rate of each test fop those biochem stage 3-5, vs primis recorded 3-5
+    # vs single reduced egfr
+    for test in tests_extended:
+        print(f"TEST: {test}")
+
+        # the measure tables shared by sections 3 and 4 are read once per test
+        single_egfr_measure = read_measure(f"{test}_single_egfr_population_rate")
+        stage_measure = read_measure(f"{test}_stage_population_rate")
+        biochemical_stages = sum_biochemical_stages(
+            read_measure(f"{test}_biochemical_stage_population_rate"), test
+        )
 
-# 4. plot rate of each test fop those biochem stage 3-5, vs primis recorded 3-5 vs single reduced egfr
+        # single reduced egfr
+        df = single_egfr_measure.loc[single_egfr_measure["single_egfr"] == 1, :]
+        df, _ = redact(df, SUPPRESS_LOW_COUNTS, [test, "population"], "date", "value")
 
-for test in tests_extended:
-    single_egfr = pd.read_csv(
-        OUTPUT_DIR / f"joined/measure_{test}_single_egfr_population_rate.csv",
-        parse_dates=["date"],
-    )
-    single_egfr = single_egfr.loc[single_egfr["single_egfr"] == 1, :]
-    single_egfr = single_egfr.drop(
-        [
-            "single_egfr",
-        ],
-        axis=1,
-    )
-    # round test column and population column to nearest 5 and recalculate value
-    single_egfr[test] = round_column(single_egfr[test], 5)
-    single_egfr["population"] = round_column(single_egfr["population"], 5)
-    single_egfr["value"] = single_egfr[test] / single_egfr["population"]
-
-    primis_stage = pd.read_csv(
-        OUTPUT_DIR / f"joined/measure_{test}_stage_population_rate.csv",
-        parse_dates=["date"],
-    )
-    primis_stage = primis_stage.loc[primis_stage["ckd_primis_stage"].isin([3, 4, 5]), :]
-    primis_stage = (
-        primis_stage.groupby(by=["date"])[[test, "population"]].sum().reset_index()
-    )
-    primis_stage[test] = round_column(primis_stage[test], 5)
-    primis_stage["population"] = round_column(primis_stage["population"], 5)
+        plot_measures(
+            df=df,
+            filename=f"plot_single_reduced_egfr_{test}",
+            title=f"",
+            column_to_plot="value",
+            y_label="Proportion",
+            as_bar=False,
+            queue=figures,
+        )
 
-    primis_stage["value"] = primis_stage[test] / primis_stage["population"]
+        df_ckd_stage_egfr, df_ckd_stage_acr, _ = biochemical_stages
+        df_ckd_stage_egfr = df_ckd_stage_egfr.copy()
+        df_ckd_stage_egfr["value"] = (
+            df_ckd_stage_egfr[test] / df_ckd_stage_egfr["population"]
+        )
 
-    ckd_stage = pd.read_csv(
-        OUTPUT_DIR / f"joined/measure_{test}_biochemical_stage_population_rate.csv",
-        parse_dates=["date"],
-    )
-    ckd_stage = ckd_stage.loc[
-        ckd_stage["ckd_egfr_category"].isin(["G3a", "G3b", "G4", "G5"]), :
-    ]
-    ckd_stage = ckd_stage.groupby(by=["date"])[[test, "population"]].sum().reset_index()
-    ckd_stage[test] = round_column(ckd_stage[test], 5)
-    ckd_stage["population"] = round_column(ckd_stage["population"], 5)
-    ckd_stage["value"] = ckd_stage[test] / ckd_stage["population"]
+        df_ckd_stage_egfr = df_ckd_stage_egfr.replace(np.inf, np.nan)
+        df_ckd_stage_egfr, _ = redact(
+            df_ckd_stage_egfr,
+            SUPPRESS_LOW_COUNTS,
+            [test, "population"],
+            "date",
+            "value",
+        )
+        df_ckd_stage_egfr.to_csv(
+            f"output/pub/tests_by_ckd_stage/plot_ckd_biochemical_stage_{test}_egfr.csv",
+            index=False,
+        )
 
-    # now plot on the same axis
-    fig, ax = plt.subplots(figsize=(12, 8))
-    ax.plot(
-        single_egfr["date"],
-        single_egfr["value"],
-        label="Single reduced eGFR",
-        color="red",
-    )
-    ax.plot(
-        primis_stage["date"],
-        primis_stage["value"],
-        label="CKD stage (recorded)",
-        color="blue",
-    )
-    ax.plot(
-        ckd_stage["date"],
-        ckd_stage["value"],
-        label="CKD stage (biochemical)",
-        color="green",
-    )
+        plot_measures(
+            df=df_ckd_stage_egfr,
+            filename=f"pub/tests_by_ckd_stage/plot_ckd_biochemical_stage_{test}_egfr",
+            title=f"",
+            column_to_plot="value",
+            y_label="Proportion",
+            as_bar=False,
+            category="ckd_egfr_category",
+            queue=figures,
+        )
 
-    # combine 3 dfs and save
-    single_egfr["category"] = "single_egfr"
-    primis_stage["category"] = "recorded_stage"
-    ckd_stage["category"] = "biochemical_stage"
-    combined = pd.concat([single_egfr, primis_stage, ckd_stage])
-    combined.to_csv(
-        f"output/pub/tests_by_ckd_stage/plot_{test}_single_biochem_stage.csv",
-        index=False,
-    )
-    x_labels = sorted(single_egfr["date"])
+        df_ckd_stage_acr = df_ckd_stage_acr.copy()
+        df_ckd_stage_acr["value"] = (
+            df_ckd_stage_acr[test] / df_ckd_stage_acr["population"]
+        )
 
-    ax.set_xticks(x_labels)
-    ax.set_xticklabels(x_labels, rotation="vertical")
-    ax.xaxis.set_major_formatter(mdates.DateFormatter("%Y-%m-%d"))
-    ax.set_ylabel("Proportion")
-    ax.set_xlabel("Date")
-    ax.margins(x=0)
-    ax.grid(True)
+        # df_ckd_stage = df_ckd_stage.replace(np.inf, np.nan)
+        df_ckd_stage_acr, _ = redact(
+            df_ckd_stage_acr,
+            SUPPRESS_LOW_COUNTS,
+            [test, "population"],
+            "date",
+            "value",
+        )
 
-    ax.legend(bbox_to_anchor=(1.04, 1), loc="upper left")
-    plt.tight_layout()
-    plt.savefig(f"output/pub/tests_by_ckd_stage/plot_{test}_single_biochem_stage.jpeg")
-    plt.close()
+        df_ckd_stage_acr.to_csv(
+            f"output/pub/tests_by_ckd_stage/plot_ckd_biochemical_stage_{test}_acr.csv",
+            index=False,
+        )
 
-# 5.  plot rate of testing in those at risk in the general pop not in UKRR vs those that are in UKRR
+        plot_measures(
+            df=df_ckd_stage_acr,
+            filename=f"plot_ckd_biochemical_stage_{test}_acr",
+            title=f"",
+            column_to_plot="value",
+            y_label="Proportion",
+            as_bar=False,
+            category="ckd_acr_category",
+            queue=figures,
+        )
 
+        df_recorded_stage = stage_measure.replace(np.inf, np.nan)
 
-# # 2019_prevalence a prevalence cohort of patients alive and on RRT in December 2019
-# # 2020_prevalence a prevalence cohort of patients alive and on RRT in December 2020
-# # 2021_prevalence a prevalence cohort of patients alive and on RRT in December 2021
-# # 2020_incidence an incidence cohort of patients who started RRT in 2020
-# # 2020_ckd a snapshot prevalence cohort of patient with Stage 4 or 5 CKD who were reported to the UKRR to be under renal care in December 2020
+        df_recorded_stage, _ = redact(
+            df_recorded_stage,
+            SUPPRESS_LOW_COUNTS,
+            [test, "population"],
+            "date",
+            "value",
+        )
 
+        df_recorded_stage.to_csv(
+            f"output/pub/tests_by_ckd_stage/plot_ckd_recorded_stage_{test}.csv",
+            index=False,
+        )
+        plot_measures(
+            df=df_recorded_stage,
+            filename=f"pub/tests_by_ckd_stage/plot_ckd_recorded_stage_{test}",
+            title=f"",
+            column_to_plot="value",
+            y_label="Proportion",
+            as_bar=False,
+            category="ckd_primis_stage",
+            queue=figures,
+        )
+
+        # 4. biochemical stage 3-5 vs recorded stage 3-5 vs single reduced egfr
+        single_egfr = single_egfr_measure.loc[
+            single_egfr_measure["single_egfr"] == 1, :
+        ]
+        single_egfr = single_egfr.drop(
+            [
+                "single_egfr",
+            ],
+            axis=1,
+        )
+        # round test column and population column to nearest 5 and recalculate value
+        single_egfr[test] = round_column(single_egfr[test], 5)
+        single_egfr["population"] = round_column(single_egfr["population"], 5)
+        single_egfr["value"] = single_egfr[test] / single_egfr["population"]
+
+        primis_stage = stage_measure.loc[
+            stage_measure["ckd_primis_stage"].isin([3, 4, 5]), :
+        ]
+        primis_stage = (
+            primis_stage.groupby(by=["date"])[[test, "population"]].sum().reset_index()
+        )
+        primis_stage[test] = round_column(primis_stage[test], 5)
+        primis_stage["population"] = round_column(primis_stage["population"], 5)
+
+        primis_stage["value"] = primis_stage[test] / primis_stage["population"]
+
+        ckd_stage = biochemical_stages[2].copy()
+        ckd_stage[test] = round_column(ckd_stage[test], 5)
+        ckd_stage["population"] = round_column(ckd_stage["population"], 5)
+        ckd_stage["value"] = ckd_stage[test] / ckd_stage["population"]
+
+        # now plot on the same axis
+        figures.append(
+            figure_spec(
+                draw_single_biochem_stage,
+                f"output/pub/tests_by_ckd_stage/plot_{test}_single_biochem_stage.jpeg",
+                figsize=(12, 8),
+                single_egfr=single_egfr[["date", "value"]],
+                primis_stage=primis_stage[["date", "value"]],
+                ckd_stage=ckd_stage[["date", "value"]],
+                x_labels=sorted(single_egfr["date"]),
+            )
+        )
 
-measures = {}
+        # combine 3 dfs and save
+        single_egfr["category"] = "single_egfr"
+        primis_stage["category"] = "recorded_stage"
+        ckd_stage["category"] = "biochemical_stage"
+        combined = pd.concat([single_egfr, primis_stage, ckd_stage])
+        combined.to_csv(
+            f"output/pub/tests_by_ckd_stage/plot_{test}_single_biochem_stage.csv",
+            index=False,
+        )
 
-for path in Path("output/joined").glob("input_20*.csv.gz"):
-    df = pd.read_csv(path)
-    df = df.loc[(df["at_risk"] == 1), :]
-    date = get_date_input_file(path.name)
+    # 5.  plot rate of testing in those at risk in the general pop not in UKRR vs those that are in UKRR
+
+    # # 2019_prevalence a prevalence cohort of patients alive and on RRT in December 2019
+    # # 2020_prevalence a prevalence cohort of patients alive and on RRT in December 2020
+    # # 2021_prevalence a prevalence cohort of patients alive and on RRT in December 2021
+    # # 2020_incidence an incidence cohort of patients who started RRT in 2020
+    # # 2020_ckd a snapshot prevalence cohort of patient with Stage 4 or 5 CKD who were reported to the UKRR to be under renal care in December 2020
 
     # if the file is between Jan 2020 and end of Dec 2020,
     # should flag as in UKRR if flag is 1 in 2019_prevalence
@@ -338,75 +343,55 @@ for path in Path("output/joined").glob("input_20*.csv.gz"):
 
     # if the file is between Jan 2022 and end of Dec 2022,
     # should flag as in UKRR if flag is 1 in 2021_prevalence
-    year = date.split("-")[0]
-
-    if year in ["2020", "2021", "2022"]:
-        if year == "2020":
-            df["in_ukrr"] = df["ukrr_2019"]
-
-        elif year == "2021":
-            df["in_ukrr"] = df["ukrr_2020"]
-
-        elif year == "2022":
-            df["in_ukrr"] = df["ukrr_2021"]
+    ukrr_flags = {"2020": "ukrr_2019", "2021": "ukrr_2020", "2022": "ukrr_2021"}
+
+    # only open the files of those years, reading the tests and flags of the at risk
+    # population, one file per process
+    paths = [
+        path
+        for path in sorted(Path("output/joined").glob("input_20*.csv.gz"))
+        if get_date_input_file(path.name)[:4] in ukrr_flags
+    ]
+    file_sums = parallel_map(
+        partial(
+            sum_by_flag,
+            columns=tests_extended,
+            flags=ukrr_flags,
+            where_column="at_risk",
+        ),
+        paths,
+    )
 
+    measures = {test: {"not_ukrr": {}, "ukrr": {}} for test in tests_extended}
+    for path, sums in zip(paths, file_sums):
+        date = get_date_input_file(path.name)
         for test in tests_extended:
-            if test not in measures:
-                measures[test] = {"not_ukrr": {}, "ukrr": {}}
-
-            measures[test]["not_ukrr"][date] = (
-                df.loc[df["in_ukrr"] == 0, test].sum(),
-                len(df.loc[df["in_ukrr"] == 0, :]),
-            )
-            measures[test]["ukrr"][date] = (
-                df.loc[df["in_ukrr"] == 1, test].sum(),
-                len(df.loc[df["in_ukrr"] == 1, :]),
-            )
-
-# convert measures to 3 dataframes - one for each test. columns = numerator, denominator, date, group
-
-for test in tests_extended:
-    df_total = pd.DataFrame()
-    df_ukrr = pd.DataFrame()
-
-    for date in measures[test]["not_ukrr"].keys():
-        df_total = pd.concat(
-            [
-                df_total,
-                pd.DataFrame(
-                    {
-                        "numerator": measures[test]["not_ukrr"][date][0],
-                        "denominator": measures[test]["not_ukrr"][date][1],
-                        "date": date,
-                        "group": "not_ukrr",
-                    },
-                    index=[0],
-                ),
-            ]
-        )
-
-        df_ukrr = pd.concat(
-            [
-                df_ukrr,
-                pd.DataFrame(
-                    {
-                        "numerator": measures[test]["ukrr"][date][0],
-                        "denominator": measures[test]["ukrr"][date][1],
-                        "date": date,
-                        "group": "ukrr",
-                    },
-                    index=[0],
-                ),
-            ]
+            for group, in_ukrr in [("not_ukrr", 0), ("ukrr", 1)]:
+                measures[test][group][date] = (
+                    sums.loc[in_ukrr, test],
+                    sums.loc[in_ukrr, "count"],
+                )
+
+    # convert measures to a dataframe for each test, with a row per group and date:
+    # columns = numerator, denominator, date, group
+    for test in tests_extended:
+        rows = [
+            (numerator, denominator, date, group)
+            for group in ["not_ukrr", "ukrr"]
+            for date, (numerator, denominator) in measures[test][group].items()
+        ]
+        combined = pd.DataFrame(
+            rows, columns=["numerator", "denominator", "date", "group"]
         )
 
-        combined = pd.concat([df_total, df_ukrr])
-
         # redact any values <=7 in numerator and denominator, then round the values to the nearest 5
-        combined = redact_small_numbers(
-            combined, 7, 5, "numerator", "denominator", "value", "date"
+        combined, _ = redact(
+            combined,
+            SUPPRESS_LOW_COUNTS,
+            ["numerator", "denominator"],
+            "date",
+            "value",
         )
-        combined["value"] = combined["numerator"] / combined["denominator"]
         combined.loc[:, ["date", "numerator", "denominator", "value"]].to_csv(
             f"output/pub/ukrr_testing/plot_{test}_total_ukrr.csv", index=False
         )
@@ -419,4 +404,11 @@ for test in tests_extended:
             y_label="Proportion",
             as_bar=False,
             category="group",
+            queue=figures,
         )
+
+    render_figures(figures)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,45 +1,75 @@
+import argparse
 import pandas as pd
 import numpy as np
 from pathlib import Path
-from utilities import OUTPUT_DIR, match_input_files, plot_distribution_numeric_value
+from utilities import (
+    OUTPUT_DIR,
+    cached_partial,
+    histogram_counts,
+    iter_extract,
+    match_input_files,
+    plot_distribution_counts,
+)
 from variables import tests_extended
 
 Path.mkdir(OUTPUT_DIR / f"pub/numeric_values", parents=True, exist_ok=True)
 
 tests_bins = {
-    "albumin": {"start": 0, "end": 100, "width": 5},
-    "creatinine": {"start": 0, "end": 150, "width": 10},
-    "eGFR": {"start": 0, "end": 120, "width": 10},
-    "cr_cl": {"start": 0, "end": 100, "width": 10},
-    "acr": {"start": 0, "end": 30, "width": 5},
+    "albumin": {"start": 0, "end": 100, "bin_width": 5},
+    "creatinine": {"start": 0, "end": 150, "bin_width": 10},
+    "eGFR": {"start": 0, "end": 120, "bin_width": 10},
+    "cr_cl": {"start": 0, "end": 100, "bin_width": 10},
+    "acr": {"start": 0, "end": 30, "bin_width": 5},
 }
 
-for test in tests_extended:
-    numeric_values = []
-    for file in (OUTPUT_DIR / "joined").iterdir():
-        if match_input_files(file.name):
-            df = pd.read_csv(
-                (OUTPUT_DIR / "joined") / file.name, usecols=[f"{test}_numeric_value"]
-            )
-            numeric_values.append(
-                np.array(
-                    df.loc[
-                        (
-                            (df[f"{test}_numeric_value"].notnull())
-                            & (df[f"{test}_numeric_value"] > 0)
-                        ),
-                        f"{test}_numeric_value",
-                    ]
-                )
-            )
-    numeric_values_combined = np.concatenate(numeric_values)
 
+def histogram_numeric_values(path, tests_bins):
+    """Counts the positive values of each test's numeric value column of a cohort
+    extract in the test's bins, reading the extract once"""
+    counts = {
+        test: histogram_counts(np.empty(0), **bins) for test, bins in tests_bins.items()
+    }
+    columns = [f"{test}_numeric_value" for test in tests_bins]
+    for df in iter_extract(path, usecols=columns):
+        for test, bins in tests_bins.items():
+            numeric_values = df[f"{test}_numeric_value"].to_numpy()
+            # missing values are excluded by the > 0 comparison
+            numeric_values = numeric_values[numeric_values > 0]
+            counts[test] += histogram_counts(numeric_values, **bins)
+    return counts
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    "--partials_dir",
+    dest="partials_dir",
+    type=Path,
+    default=None,
+    help="Directory of stored counts of each monthly extract, reused by reruns for "
+    "extracts that haven't changed. The counts are derived from patient level "
+    "data, so are not stored by default",
+)
+args = parser.parse_args()
+
+counts = {
+    test: histogram_counts(np.empty(0), **tests_bins[test]) for test in tests_extended
+}
+for file in sorted((OUTPUT_DIR / "joined").iterdir()):
+    if match_input_files(file.name):
+        file_counts = cached_partial(
+            (OUTPUT_DIR / "joined") / file.name,
+            func=histogram_numeric_values,
+            store_dir=args.partials_dir,
+            tests_bins={test: tests_bins[test] for test in tests_extended},
+        )
+        for test in tests_extended:
+            counts[test] += file_counts[test]
+
+for test in tests_extended:
     # distribution plot
-    plot_distribution_numeric_value(
-        numeric_values_combined,
+    plot_distribution_counts(
+        counts[test],
         f"{test} numeric value distribution",
         f"pub/numeric_values/{test}_dist",
-        tests_bins[test]["start"],
-        tests_bins[test]["end"],
-        tests_bins[test]["width"],
+        **tests_bins[test],
     )
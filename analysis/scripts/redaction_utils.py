@@ -1,24 +1,34 @@
 import pandas as pd
 import numpy as np
-
-
-def round_column(column, base):
-    return column.apply(lambda x: base * round(x / base) if pd.notnull(x) else x)
-
-
-def round_values(x, base=5):
-    rounded = x
-    if isinstance(x, (int, float)):
-        if np.isnan(x):
-            rounded = np.nan
-        else:
-            rounded = int(base * round(x / base))
-    return rounded
-
-
-def drop_and_round(column, base=5, threshold=7):
-    column[column <= threshold] = 0
-    return round_column(column, base)
+from collections import namedtuple
+from rounding import drop_and_round, round_column, round_to_base
+
+RedactionPolicy = namedtuple(
+    "RedactionPolicy",
+    ["threshold", "rounding_base", "suppression", "rate"],
+    defaults=[7, 5, "zero", "redact"],
+)
+RedactionPolicy.__doc__ = """A disclosure control policy, applied by redact.
+
+threshold: Counts <= threshold are suppressed.
+rounding_base: The other counts are rounded to the nearest multiple of it.
+suppression: How low counts are suppressed: "zero" publishes them as 0, "remove"
+    drops their rows, "secondary" makes them (and enough further counts of their
+    group for the suppressed count to be > threshold) missing, and "group" adds
+    them (and enough further counts) up into an "Other" count.
+rate: With "secondary" suppression, whether rates of suppressed counts are made
+    missing ("redact") or all rates are recomputed from the redacted counts
+    ("recompute").
+"""
+
+# counts <= 7 published as 0, the others rounded to the nearest 5
+ZERO_LOW_COUNTS = RedactionPolicy()
+# rows with counts <= 7 left out, the others rounded to the nearest 5
+REMOVE_LOW_COUNTS = RedactionPolicy(suppression="remove")
+# numerators and denominators <= 7 suppressed within each date
+SUPPRESS_LOW_COUNTS = RedactionPolicy(suppression="secondary", rate="recompute")
+# counts <= 7 grouped into "Other"
+GROUP_LOW_COUNTS = RedactionPolicy(suppression="group")
 
 
 def compute_redact_deciles(df, period_column, count_column, column):
@@ -47,6 +57,70 @@ def compute_redact_deciles(df, period_column, count_column, column):
     return df
 
 
+def suppress_small_numbers(values, groups, labels, n, active=None):
+    """Finds the cells removed by low number suppression within each group.
+
+    If the cells <= n of a group sum to more than 0, they are suppressed and, while
+    the suppressed count is <= n, the smallest remaining cell (the first of equal
+    cells) is suppressed too. Suppressing a cell suppresses every cell of its group
+    with the same index label, as setting a Series item by label does.
+    Args:
+        values: Array of counts.
+        groups: Array of group codes, from 0.
+        labels: Array of index label codes.
+        n: Threshold for low number suppression.
+        active: Optional boolean array of the groups whose cells <= n are
+            suppressed. Defaults to those where these cells don't sum to 0. Further
+            cells are only suppressed in groups where they don't.
+    Returns:
+        A tuple of a boolean array, True for suppressed cells, and an array of the
+        suppressed count of each group, missing where every cell was suppressed
+        without it exceeding n.
+    """
+    values = np.asarray(values, dtype=float)
+    groups = np.asarray(groups)
+    labels = np.asarray(labels)
+    n_groups = groups.max() + 1 if len(groups) else 0
+
+    small = values <= n
+    small_count = np.bincount(
+        groups, weights=np.where(small, values, 0), minlength=n_groups
+    )
+    if active is None:
+        active = small_count != 0
+    suppressed = small & active[groups]
+
+    # the cells that further suppression would take, smallest first, skipping
+    # cells whose label has already been taken. The cut point is where the
+    # cumulative suppressed count first exceeds n
+    candidates = np.flatnonzero(
+        ~small & ~np.isnan(values) & (active & (small_count != 0))[groups]
+    )
+    candidates = candidates[
+        np.lexsort((candidates, values[candidates], groups[candidates]))
+    ]
+    group_labels = groups.astype(np.int64) * (labels.max(initial=-1) + 2) + labels + 1
+    candidates = candidates[~pd.Series(group_labels[candidates]).duplicated().values]
+
+    # a cell is taken while the suppressed count before it is <= n
+    taken_values = pd.Series(values[candidates])
+    count_before = (
+        small_count[groups[candidates]]
+        + taken_values.groupby(groups[candidates]).cumsum().values
+        - taken_values.values
+    )
+    taken = candidates[count_before <= n]
+
+    suppressed_count = small_count + np.bincount(
+        groups[taken], weights=values[taken], minlength=n_groups
+    )
+    exhausted = (active & (small_count != 0)) & (suppressed_count <= n)
+    suppressed_count[exhausted] = np.nan
+
+    suppressed = suppressed | np.isin(group_labels, group_labels[taken])
+    return suppressed, suppressed_count
+
+
 def redact_small_numbers(
     df, n, rounding_base, numerator, denominator, rate_column, date_column
 ):
@@ -61,66 +135,115 @@ def redact_small_numbers(
     numerator: numerator column to be redacted
     denominator: denominator column to be redacted
     """
+    # rows are grouped by date, in order of each date's first row. Rows with a
+    # missing date are dropped
+    groups, _ = pd.factorize(df[date_column])
+    has_missing_date = (groups == -1).any()
+    order = np.argsort(groups, kind="stable")
+    order = order[groups[order] != -1]
+    df = df.iloc[order].copy()
+    groups = groups[order]
+    labels, _ = pd.factorize(df.index)
+
+    for column in [numerator, denominator]:
+        dtype = df[column].dtype
+        suppressed, _ = suppress_small_numbers(df[column], groups, labels, n)
+        redacted = df[column].where(~suppressed) if suppressed.any() else df[column]
+
+        # the suppressed, unrounded denominator is kept in "column"
+        df["column"] = redacted
+        df[column] = round_column(redacted, base=rounding_base)
+
+        # the dates were redacted separately and concatenated, so the (empty)
+        # subset of a missing date kept the columns' original types
+        if has_missing_date:
+            for redacted_column in [column, "column"]:
+                df[redacted_column] = df[redacted_column].astype(
+                    np.result_type(df[redacted_column].dtype, dtype)
+                )
+
+    df.loc[(df[numerator].isna()) | (df[denominator].isna()), rate_column] = np.nan
+    return df
 
-    def suppress_column(column):
-        suppressed_count = column[column <= n].sum()
-
-        # if 0 dont need to suppress anything
-        if suppressed_count == 0:
-            pass
-
-        else:
-            column[column <= n] = np.nan
-
-            while suppressed_count <= n:
-                suppressed_count += column.min()
-
-                column[column.idxmin()] = np.nan
-        return column
-
-    df_list = []
-
-    dates = df[date_column].unique()
-
-    for d in dates:
-        df_subset = df.loc[df[date_column] == d, :]
-
-        for column in [numerator, denominator]:
-            df_subset = df_subset.assign(column=suppress_column(df_subset[column]))
-
-            df_subset[column] = round_column(df_subset[column], base=rounding_base)
-
-        df_subset.loc[
-            (df_subset[numerator].isna()) | (df_subset[denominator].isna()), rate_column
-        ] = np.nan
-        df_list.append(df_subset)
-    
-    combined_df = pd.concat(df_list, axis=0)
-    combined_df[rate_column] = combined_df[numerator] / combined_df[denominator]
-    return pd.concat(df_list, axis=0)
-
-
-def group_low_values_series(series):
-    suppressed_count = series[series <= 7].sum()
 
-    if suppressed_count == 0:
-        series = round_column(series, 5)
+def group_low_values_series(series, level=None, threshold=7, rounding_base=5):
+    """Suppresses low counts and groups them into an "Other" count.
 
+    If the counts <= threshold sum to more than 0, they are suppressed, as are the
+    smallest other counts until the suppressed count is > threshold. The remaining
+    counts are kept unrounded, followed by the suppressed count, rounded, as
+    "Other". If not, the counts are rounded.
+    Args:
+        series: A Series of counts.
+        level: If given (0 or 1), counts are grouped separately within each value
+            of this level of a two level index, and the "Other" counts are labelled
+            with the value and "Other".
+        threshold: Redaction threshold to use
+        rounding_base: Rounding base to use
+    Returns:
+        A Series of redacted counts
+    """
+    values = series.to_numpy(dtype=float)
+    if level is None:
+        groups = np.zeros(len(series), dtype=np.int64)
     else:
-        series[series <= 7] = np.nan
-
-        while suppressed_count <= 7:
-            suppressed_count += series.min()
-            series[series.idxmin()] = np.nan
-
-        series = series[series.notnull()]
+        groups, keys = pd.factorize(series.index.get_level_values(level), sort=True)
+    labels, _ = pd.factorize(series.index)
+
+    in_group = groups != -1
+    small_count = np.bincount(
+        groups[in_group],
+        weights=np.where(values <= threshold, values, 0)[in_group],
+        minlength=groups.max(initial=-1) + 1,
+    )
+    active = small_count != 0
+    rounded = round_to_base(values, rounding_base)
+
+    if len(series) == 0:
+        return series.copy()
+    if not active.any():
+        if not np.isnan(rounded).any():
+            rounded = rounded.astype(np.int64)
+        return pd.Series(rounded, index=series.index, name=series.name)
+
+    suppressed, suppressed_count = suppress_small_numbers(
+        values[in_group], groups[in_group], labels[in_group], threshold
+    )
+    values, rounded, groups = values[in_group], rounded[in_group], groups[in_group]
+    index = series.index[in_group]
+
+    # the remaining counts of each group, followed by its "Other" count
+    kept = np.flatnonzero(~active[groups] | (~suppressed & ~np.isnan(values)))
+    other = np.flatnonzero(active)
+    order = np.lexsort(
+        (
+            np.concatenate([kept, np.zeros(len(other), dtype=kept.dtype)]),
+            np.repeat([0, 1], [len(kept), len(other)]),
+            np.concatenate([groups[kept], other]),
+        )
+    )
+    counts = np.concatenate(
+        [
+            np.where(active[groups], values, rounded)[kept],
+            round_to_base(suppressed_count[other], rounding_base),
+        ]
+    )
 
-        suppressed_count_series = pd.Series(suppressed_count, index=["Other"])
-        suppressed_count_series = round_column(suppressed_count_series, 5)
+    # counts are integers if all of them were rounded
+    if not active[groups[kept]].any() and not np.isnan(counts).any():
+        counts = counts.astype(np.int64)
 
-        series = pd.concat([series, suppressed_count_series])
+    if level is None:
+        index = index[kept].append(pd.Index(["Other"]))
+    else:
+        levels = [None, None]
+        levels[level] = index.get_level_values(level)[kept].append(keys[other])
+        levels[1 - level] = index.get_level_values(1 - level)[kept].append(
+            pd.Index(["Other"] * len(other))
+        )
+        index = pd.MultiIndex.from_arrays(levels, names=series.index.names)
 
-    return series
+    return pd.Series(counts[order], index=index[order])
 
 
 def group_low_values(df, count_column, code_column, threshold, rounding_base):
@@ -135,31 +258,36 @@ def group_low_values(df, count_column, code_column, threshold, rounding_base):
     Returns:
         A table with redacted counts
     """
+    df = df.copy()
 
     # get sum of any values <= threshold
-    suppressed_count = df.loc[df[count_column] <= threshold, count_column].sum()
-    suppressed_df = df.loc[df[count_column] > threshold, count_column]
+    small = (df[count_column] <= threshold).to_numpy()
+    suppressed_count = df.loc[small, count_column].sum()
 
     # if suppressed values >0 ensure total suppressed count > threshold.
     # Also suppress if all values 0
     if (suppressed_count > 0) | (
-        (suppressed_count == 0) & (len(suppressed_df) != len(df))
+        (suppressed_count == 0) & ~(df[count_column] > threshold).all()
     ):
-        # redact counts <= threshold
-        df.loc[df[count_column] <= threshold, count_column] = np.nan
-
-        # If all values 0, suppress them
-        if suppressed_count == 0:
-            df.loc[df[count_column] == 0, :] = np.nan
+        suppressed, (suppressed_count,) = suppress_small_numbers(
+            df[count_column],
+            np.zeros(len(df), dtype=np.int64),
+            pd.factorize(df.index)[0],
+            threshold,
+            active=np.array([True]),
+        )
 
-        else:
-            # if suppressed count <= threshold redact further values
-            while suppressed_count <= threshold:
-                suppressed_count += df[count_column].min()
-                df.loc[df[count_column].idxmin(), :] = np.nan
+        # redact counts <= threshold, and the whole rows of further values
+        df.loc[small, count_column] = np.nan
+        if (suppressed & ~small).any():
+            df.loc[suppressed & ~small, :] = np.nan
 
         # drop all rows where count column is null
         df = df.loc[df[count_column].notnull(), :]
+        if np.isnan(suppressed_count):
+            # every row was suppressed. Keep the index type the row by row
+            # suppression gave, having run out of rows to suppress
+            df.index = df.index.append(pd.Index([np.nan]))[:0]
 
         # add suppressed count as "Other" row (if > threshold)
         if suppressed_count > threshold:
@@ -172,8 +300,97 @@ def group_low_values(df, count_column, code_column, threshold, rounding_base):
 
 
 def redact_table_1(df):
-    redacted_table = df.groupby(level=[0]).apply(group_low_values_series)
-    return redacted_table
+    """Groups low counts of each condition into an "Other" count"""
+    return group_low_values_series(df, level=0)
+
+
+def summarise_counts(table, columns=None):
+    """Gets the number of non missing counts of a table (or of some of its columns)
+    and their total"""
+    values = table[columns] if columns is not None else table
+    return int(np.sum(values.count())), float(np.sum(values.sum()))
+
+
+def redact(table, policy, columns=None, groups=None, rate_column=None):
+    """Applies a disclosure control policy to a table of counts.
+    Args:
+        table: A Series or a data frame of counts.
+        policy: The RedactionPolicy to apply.
+        columns: The count columns of a data frame. Defaults to all of them. For
+            "secondary" suppression, the numerator and denominator columns.
+        groups: For "secondary" suppression, the (date) column within which counts
+            are suppressed. For "group" suppression, the index level within which
+            counts are grouped, if any.
+        rate_column: For "secondary" suppression, the column of numerator /
+            denominator rates.
+    Returns:
+        A tuple of the redacted table and an audit record: a dict of the policy,
+        the number of counts and their total before and after redaction, and the
+        number of counts suppressed.
+    """
+    threshold, rounding_base = policy.threshold, policy.rounding_base
+    n_counts, total = summarise_counts(table, columns)
+
+    if policy.suppression == "zero":
+        if columns is None:
+            redacted = drop_and_round(table, rounding_base, threshold)
+        else:
+            redacted = table.copy()
+            for column in columns:
+                redacted[column] = drop_and_round(
+                    table[column], rounding_base, threshold
+                )
+        values = table[columns] if columns is not None else table
+        n_suppressed = np.sum(((values <= threshold) & (values != 0)).sum())
+
+    elif policy.suppression == "remove":
+        values = table[columns] if columns is not None else table
+        keep = values > threshold
+        if keep.ndim > 1:
+            keep = keep.all(axis=1)
+        redacted = table[keep]
+        if columns is None:
+            redacted = round_column(redacted, rounding_base)
+        else:
+            redacted = redacted.copy()
+            for column in columns:
+                redacted[column] = round_column(redacted[column], rounding_base)
+        n_suppressed = n_counts - summarise_counts(redacted, columns)[0]
+
+    elif policy.suppression == "secondary":
+        numerator, denominator = columns
+        redacted = redact_small_numbers(
+            table,
+            threshold,
+            rounding_base,
+            numerator,
+            denominator,
+            rate_column,
+            groups,
+        ).drop(columns="column")
+        if policy.rate == "recompute":
+            redacted[rate_column] = redacted[numerator] / redacted[denominator]
+        n_suppressed = n_counts - summarise_counts(redacted, columns)[0]
+
+    elif policy.suppression == "group":
+        redacted = group_low_values_series(table, groups, threshold, rounding_base)
+        other = redacted.index.get_level_values(
+            -1 if groups is None else 1 - groups
+        ) == "Other"
+        n_suppressed = n_counts - redacted[~other].count()
+        redacted = drop_and_round(redacted, rounding_base, threshold)
+
+    else:
+        raise ValueError(f"Unknown suppression {policy.suppression!r}")
+
+    audit = {
+        **policy._asdict(),
+        "counts": n_counts,
+        "suppressed": int(n_suppressed),
+        "total": total,
+        "redacted_total": summarise_counts(redacted, columns)[1],
+    }
+    return redacted, audit
 
 
 def create_top_5_code_table(
@@ -233,6 +450,84 @@ def create_top_5_code_table(
     return event_counts.head(5)
 
 
+def get_quantiles(has_outer_percentiles=True):
+    """Gets the quantiles of the deciles and, optionally, the nine largest and nine
+    smallest percentiles."""
+    quantiles = np.arange(0.1, 1, 0.1)
+    if has_outer_percentiles:
+        quantiles = np.concatenate(
+            [quantiles, np.arange(0.01, 0.1, 0.01), np.arange(0.91, 1, 0.01)]
+        )
+    return quantiles
+
+
+def compute_group_quantiles(groups, values, quantiles):
+    """Computes quantiles of the values of each group, sorting the values once.
+
+    Quantiles are linearly interpolated exactly as pandas' groupby quantile does, so
+    results are identical to it. Missing values are skipped, and missing groups
+    dropped.
+    Args:
+        groups: Array-like of group keys.
+        values: Array-like of numeric values.
+        quantiles: Array of quantiles between 0 and 1.
+    Returns:
+        A tuple of the sorted group keys and a (group x quantile) array of floats.
+    """
+    codes, keys = pd.factorize(groups, sort=True)
+    values = np.asarray(values)
+    quantiles = np.asarray(quantiles, dtype=float)
+
+    keep = (codes != -1) & ~pd.isna(values)
+    codes, values = codes[keep], values[keep]
+    if len(values) == 0:
+        return keys, np.full((len(keys), len(quantiles)), np.nan)
+
+    # values sorted within groups, and the position of each group's first value
+    values = values[np.lexsort((values, codes))]
+    sizes = np.bincount(codes, minlength=len(keys))
+    starts = np.cumsum(sizes) - sizes
+
+    q_idx = quantiles * (np.maximum(sizes, 1) - 1).astype(float)[:, np.newaxis]
+    frac = q_idx % 1
+    idx = np.minimum(starts[:, np.newaxis] + q_idx.astype(np.int64), len(values) - 1)
+    next_idx = np.minimum(idx + 1, len(values) - 1)
+
+    val = values[idx]
+    next_val = values[next_idx]
+    if np.issubdtype(values.dtype, np.floating):
+        val, next_val = val.astype(float), next_val.astype(float)
+    with np.errstate(invalid="ignore"):
+        interpolated = val + (next_val - val).astype(float) * frac
+    result = np.where(frac == 0, val, interpolated).astype(float)
+    result[sizes == 0] = np.nan
+    return keys, result
+
+
+def compute_deciles_wide(
+    measure_table, groupby_col, values_col, has_outer_percentiles=True
+):
+    """Computes deciles, one row per group.
+    Args:
+        measure_table: A measure table.
+        groupby_col: The name of the column to group by.
+        values_col: The name of the column for which deciles are computed.
+        has_outer_percentiles: Whether to compute the nine largest and nine smallest
+            percentiles as well as the deciles.
+    Returns:
+        A data frame indexed by `groupby_col`, with a column for each percentile.
+    """
+    quantiles = get_quantiles(has_outer_percentiles)
+    keys, result = compute_group_quantiles(
+        measure_table[groupby_col], measure_table[values_col], quantiles
+    )
+    return pd.DataFrame(
+        result,
+        index=pd.Index(keys, name=groupby_col),
+        columns=pd.Index((quantiles * 100).astype(int), name="percentile"),
+    )
+
+
 def compute_deciles(measure_table, groupby_col, values_col, has_outer_percentiles=True):
     """Computes deciles.
     Args:
@@ -244,18 +539,16 @@ def compute_deciles(measure_table, groupby_col, values_col, has_outer_percentile
     Returns:
         A data frame with `groupby_col`, `values_col`, and `percentile` columns.
     """
-    quantiles = np.arange(0.1, 1, 0.1)
-    if has_outer_percentiles:
-        quantiles = np.concatenate(
-            [quantiles, np.arange(0.01, 0.1, 0.01), np.arange(0.91, 1, 0.01)]
-        )
-
-    percentiles = (
-        measure_table.groupby(groupby_col)[values_col]
-        .quantile(pd.Series(quantiles))
-        .reset_index()
+    quantiles = get_quantiles(has_outer_percentiles)
+    keys, result = compute_group_quantiles(
+        measure_table[groupby_col], measure_table[values_col], quantiles
     )
 
-    percentiles["percentile"] = percentiles["level_1"].apply(lambda x: int(x * 100))
-
-    return percentiles
+    return pd.DataFrame(
+        {
+            groupby_col: np.repeat(keys, len(quantiles)),
+            "level_1": np.tile(quantiles, len(keys)),
+            values_col: result.ravel(),
+            "percentile": np.tile((quantiles * 100).astype(int), len(keys)),
+        }
+    )
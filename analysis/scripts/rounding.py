@@ -0,0 +1,71 @@
+"""Rounding of counts for disclosure control.
+
+Counts are rounded to the nearest multiple of a base, with halves rounded to even
+as Python's round() does, on whole arrays at once. Missing counts stay missing, and
+the inputs are never modified.
+"""
+import numpy as np
+import pandas as pd
+
+
+def round_to_base(values, base=5):
+    """Rounds values to the nearest multiple of base, as base * round(x / base).
+    Args:
+        values: Array-like of numbers.
+        base: Rounding base to use.
+    Returns:
+        An array of floats.
+    """
+    values = np.asarray(values)
+    if values.dtype.kind not in "fc":
+        values = values.astype(float)
+    return base * np.round(values / base)
+
+
+def round_column(column, base=5):
+    """Rounds counts to the nearest multiple of base.
+    Args:
+        column: A Series (or array) of counts.
+        base: Rounding base to use.
+    Returns:
+        The rounded counts, of the same type as column. They are integers unless
+        any are missing.
+    """
+    if len(column) == 0:
+        return column.copy()
+
+    rounded = round_to_base(column, base)
+    if np.isnan(rounded).any():
+        rounded = rounded.astype(float)
+    else:
+        rounded = rounded.astype(np.int64)
+
+    if isinstance(column, pd.Series):
+        return pd.Series(rounded, index=column.index, name=column.name)
+    return rounded
+
+
+def drop_and_round(column, base=5, threshold=7):
+    """Sets counts <= threshold to 0 and rounds the others to the nearest multiple
+    of base.
+    Args:
+        column: A Series of counts.
+        base: Rounding base to use.
+        threshold: Redaction threshold to use.
+    Returns:
+        A Series of the redacted counts.
+    """
+    return round_column(column.mask(column <= threshold, 0), base)
+
+
+def round_values(x, base=5):
+    """Rounds a single count to the nearest multiple of base, as an int. Missing
+    counts stay missing, and anything other than an int or float is returned as it
+    is."""
+    rounded = x
+    if isinstance(x, (int, float)):
+        if np.isnan(x):
+            rounded = np.nan
+        else:
+            rounded = int(base * round(x / base))
+    return rounded
@@ -0,0 +1,233 @@
+"""Column types of the cohort extracts, derived from the study definitions.
+
+The study definitions import cohortextractor, which isn't available to the python
+actions, so their source is parsed rather than imported. Each variable's type is
+taken from the `returning` argument of its `patients.*` call.
+"""
+import ast
+from functools import lru_cache
+from pathlib import Path
+
+ANALYSIS_DIR = Path(__file__).parents[1]
+
+# what `patients.<function>` returns when it is not given `returning`
+DEFAULT_RETURNING = {
+    "with_these_clinical_events": "binary_flag",
+    "with_record_in_ukrr": "binary_flag",
+    "satisfying": "binary_flag",
+    "registered_as_of": "binary_flag",
+    "died_from_any_cause": "binary_flag",
+    "categorised_as": "category",
+    "sex": "category",
+    "comparator_from": "category",
+    "age_as_of": "int",
+    "date_of": "date",
+    "maximum_of": "date",
+    "minimum_of": "date",
+}
+
+RETURNING_TYPES = {
+    "binary_flag": "binary_flag",
+    "code": "category",
+    "category": "category",
+    "nuts1_region_name": "category",
+    "group_6": "category",
+    "treatment_modality_prevalence": "category",
+    "treatment_modality_start": "category",
+    "renal_centre": "category",
+    "numeric_value": "numeric_value",
+    "latest_creatinine": "numeric_value",
+    "latest_egfr": "numeric_value",
+    "date": "date",
+    "rrt_start_date": "date",
+    "number_of_matches_in_period": "int",
+    "pseudo_id": "int",
+    "index_of_multiple_deprivation": "int",
+}
+
+DTYPES = {
+    "binary_flag": "uint8",
+    "category": "category",
+    # float64, as pd.read_csv infers, so that values on bin and rounding edges are
+    # binned and rounded as before
+    "numeric_value": "float64",
+    "int": "int64",
+}
+
+# variables of a joined (right hand side) extract are missing for patients who are
+# not in it, so flags and integers need a type that can hold missing values
+JOINED_DTYPES = {**DTYPES, "binary_flag": "float32", "int": "float64"}
+
+
+def get_variable_type(call):
+    """Gets the type of the variable defined by a `patients.<function>(...)` call"""
+    keywords = {keyword.arg: keyword.value for keyword in call.keywords}
+    returning = keywords.get("returning")
+
+    if isinstance(returning, ast.Constant):
+        return RETURNING_TYPES.get(returning.value)
+    return DEFAULT_RETURNING.get(call.func.attr)
+
+
+def is_patients_call(node):
+    return (
+        isinstance(node, ast.Call)
+        and isinstance(node.func, ast.Attribute)
+        and isinstance(node.func.value, ast.Name)
+        and node.func.value.id == "patients"
+    )
+
+
+def includes_date_of_match(call):
+    return any(
+        keyword.arg == "include_date_of_match"
+        and isinstance(keyword.value, ast.Constant)
+        and keyword.value.value is True
+        for keyword in call.keywords
+    )
+
+
+class VariableCollector:
+    """Collects the output variables of a study definition module and the variable
+    definition modules it imports, resolving `**variables` and `**make_variables()`
+    and f-string names built in `for` loops over module level lists."""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.tree = ast.parse(self.path.read_text())
+        self.assignments = {}
+        self.functions = {}
+        self.imports = {}
+        self.lists = {}
+        self.loops = {}
+
+        for node in self.tree.body:
+            if isinstance(node, ast.Assign) and isinstance(node.targets[0], ast.Name):
+                name = node.targets[0].id
+                self.assignments[name] = node.value
+                if isinstance(node.value, ast.List):
+                    self.lists[name] = [
+                        element.value
+                        for element in node.value.elts
+                        if isinstance(element, ast.Constant)
+                    ]
+            elif isinstance(node, ast.FunctionDef):
+                self.functions[node.name] = node
+            elif isinstance(node, ast.ImportFrom) and node.module:
+                for alias in node.names:
+                    self.imports[alias.asname or alias.name] = node.module
+
+        for node in ast.walk(self.tree):
+            if (
+                isinstance(node, ast.For)
+                and isinstance(node.target, ast.Name)
+                and isinstance(node.iter, ast.Name)
+            ):
+                self.loops[node.target.id] = node.iter.id
+
+    def get_names(self, key):
+        """Gets the variable name(s) of a dict key or keyword argument"""
+        if isinstance(key, str):
+            return [key]
+        if isinstance(key, ast.Constant) and isinstance(key.value, str):
+            return [key.value]
+        if isinstance(key, ast.JoinedStr):
+            names = [""]
+            for value in key.values:
+                if isinstance(value, ast.Constant):
+                    names = [name + value.value for name in names]
+                elif isinstance(value.value, ast.Name):
+                    loop_values = self.lists.get(self.loops.get(value.value.id), [])
+                    names = [name + str(v) for name in names for v in loop_values]
+                else:
+                    return []
+            return names
+        return []
+
+    def collect_items(self, items):
+        variables = {}
+        for key, value in items:
+            if key is None:
+                variables.update(self.resolve(value))
+            elif is_patients_call(value):
+                for name in self.get_names(key):
+                    variables[name] = get_variable_type(value)
+                    if includes_date_of_match(value):
+                        variables[f"{name}_date"] = "date"
+        return variables
+
+    def resolve(self, node):
+        """Gets the variables of a node: a dict, a dict(...) or StudyDefinition(...)
+        call, a name bound to one of these, or a call to a function building them."""
+        if isinstance(node, ast.Dict):
+            return self.collect_items(zip(node.keys, node.values))
+
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name):
+            name = node.func.id
+            if name in ("dict", "StudyDefinition"):
+                return self.collect_items(
+                    (keyword.arg, keyword.value)
+                    for keyword in node.keywords
+                    if keyword.arg != "population"
+                )
+            if name in self.functions:
+                variables = {}
+                for child in ast.walk(self.functions[name]):
+                    if isinstance(child, ast.Dict):
+                        variables.update(self.resolve(child))
+                return variables
+
+        if isinstance(node, ast.Name):
+            if node.id in self.assignments:
+                return self.resolve(self.assignments[node.id])
+            if node.id in self.imports:
+                module = self.imports[node.id].replace(".", "/")
+                path = ANALYSIS_DIR / f"{module}.py"
+                if path.exists():
+                    return VariableCollector(path).resolve(node)
+
+        return {}
+
+    def collect(self, name="study"):
+        return self.resolve(ast.Name(id=name))
+
+
+def get_variable_types(study_definition):
+    """Gets the type of each variable of a study definition.
+    Args:
+        study_definition: Name of the study definition module in analysis/,
+            e.g. "study_definition".
+    Returns:
+        A dict of variable name to type ("binary_flag", "category",
+        "numeric_value", "int" or "date"). Types that can't be determined are None.
+    """
+    return VariableCollector(ANALYSIS_DIR / f"{study_definition}.py").collect()
+
+
+@lru_cache(maxsize=None)
+def get_extract_schema(
+    study_definition="study_definition", joined=("study_definition_ukrr_ethnicity",)
+):
+    """Gets the read_csv `dtype` and `parse_dates` arguments for an extract.
+    Args:
+        study_definition: Name of the study definition of the extract.
+        joined: Names of study definitions whose extracts are joined onto it (as by
+            the join_cohorts action).
+    Returns:
+        A tuple of (dtype, parse_dates): a dict of column name to dtype and a list
+        of date columns.
+    """
+    dtype = {}
+    parse_dates = []
+
+    variable_types = [(get_variable_types(study_definition), DTYPES)] + [
+        (get_variable_types(name), JOINED_DTYPES) for name in joined
+    ]
+    for types, dtypes in variable_types:
+        for column, variable_type in types.items():
+            if variable_type == "date":
+                parse_dates.append(column)
+            elif variable_type in dtypes:
+                dtype[column] = dtypes[variable_type]
+
+    return dtype, parse_dates
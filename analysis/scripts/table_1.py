@@ -1,58 +1,125 @@
+import numpy as np
 import pandas as pd
 import argparse
 import pathlib
-from utilities import OUTPUT_DIR, update_df
-from redaction_utils import redact_table_1
-
-
-def process_data(path, columns, condition_column=None):
+from utilities import (
+    OUTPUT_DIR,
+    cached_partial,
+    read_extract,
+    update_latest,
+)
+from redaction_utils import GROUP_LOW_COUNTS, redact
+
+
+# the sub-populations of Table 1, by the flag column selecting them (None for all
+# patients)
+POPULATIONS = {
+    "total": None,
+    "at_risk": "at_risk",
+    "diabetes": "diabetes",
+    "hypertension": "hypertension",
+}
+
+
+def process_data(path, columns, condition_columns=()):
     """
-    Process the data from the given path with specified columns.
-    Optionally filter data based on the condition_column.
+    Process the data from the given path with specified columns, and the
+    condition_columns flagging sub-populations.
     """
-    if condition_column is None:
-        cols_to_read = columns + ["patient_id"]
-    else:
-        cols_to_read = columns + ["patient_id", condition_column]
+    cols_to_read = columns + ["patient_id"] + list(condition_columns)
 
-    df = pd.read_csv(path, usecols=cols_to_read)
+    df = read_extract(path, usecols=cols_to_read)
 
-    if condition_column:
-        df = df[df[condition_column] == 1]
-        df.drop(condition_column, axis=1, inplace=True)
-
-    df.loc[:, columns] = df.loc[:, columns].fillna("missing")
+    for column in columns:
+        df[column] = categorise(df[column])
     return df
 
 
-def create_table_from_paths(paths, columns, condition_column=None):
-    for i, path in enumerate(paths):
-        updated_df = process_data(path, columns, condition_column)
+def categorise(column):
+    """Converts a column to a categorical with a "Missing" category, which missing
+    values and any "missing" values are recoded to."""
+    column = column.astype("category")
+    categories = column.cat.categories.astype(object)
+    categories = categories.where(categories != "missing", "Missing")
+
+    missing_categories = categories.unique()
+    if "Missing" not in missing_categories:
+        missing_categories = missing_categories.append(pd.Index(["Missing"]))
 
-        if i == 0:
-            df = updated_df
-        else:
-            df = update_df(df, updated_df, columns=columns)
+    # the code of each category, followed by that of missing values (code -1)
+    codes = np.append(
+        missing_categories.get_indexer(categories),
+        missing_categories.get_loc("Missing"),
+    )
+    return pd.Series(
+        pd.Categorical.from_codes(codes[column.cat.codes], missing_categories),
+        index=column.index,
+        name=column.name,
+    )
 
-    df = df.drop("patient_id", axis=1)
-    df = df.replace("missing", "Missing")
-    df_counts = df.apply(lambda x: x.value_counts()).T.stack()
-    df_counts = redact_table_1(df_counts)
+
+def create_table(df, columns):
+    """Counts the patients with each value of each of columns, grouping low counts."""
+    conditions = []
+    condition_values = []
+    counts = []
+    for column in columns:
+        categories = df[column].cat.categories
+        category_counts = np.bincount(df[column].cat.codes, minlength=len(categories))
+
+        # values in order, leaving out those that no patient has
+        order = np.argsort(categories.astype(str), kind="stable")
+        order = order[category_counts[order] > 0]
+
+        conditions.append(np.repeat(column, len(order)))
+        condition_values.append(categories[order])
+        counts.append(category_counts[order])
+
+    df_counts = pd.Series(
+        np.concatenate(counts),
+        index=pd.MultiIndex.from_arrays(
+            [np.concatenate(conditions), np.concatenate(condition_values)]
+        ),
+    )
+    df_counts, _ = redact(df_counts, GROUP_LOW_COUNTS, groups=0)
     df_counts.index.names = ["condition", "condition_value"]
     df_counts.name = "count"
 
     return df_counts
 
 
-def create_tables(paths, demographics):
-    df_counts_all = create_table_from_paths(paths, demographics)
-    df_counts_at_risk = create_table_from_paths(paths, demographics, "at_risk")
-    df_counts_diabetes = create_table_from_paths(paths, demographics, "diabetes")
-    df_counts_hypertension = create_table_from_paths(
-        paths, demographics, "hypertension"
-    )
+def create_tables(paths, demographics, partials_dir=None, populations=POPULATIONS):
+    """Creates Table 1 for each sub-population, reading each extract once.
+    Args:
+        paths: Paths to the cohort extracts, in date order.
+        demographics: The columns to count the values of.
+        partials_dir: Directory of stored per-extract data.
+        populations: Dict of sub-population name to the flag column selecting its
+            patients, or None for all patients.
+    Returns:
+        A dict of sub-population name to its table of counts. A patient is counted
+        with their latest record in which they are in the sub-population.
+    """
+    condition_columns = sorted({c for c in populations.values() if c is not None})
+    latest = dict.fromkeys(populations)
+
+    for path in paths:
+        df = cached_partial(
+            path,
+            func=process_data,
+            store_dir=partials_dir,
+            columns=demographics,
+            condition_columns=condition_columns,
+        )
+        records = df[["patient_id"] + demographics]
+        for name, condition_column in populations.items():
+            if condition_column is None:
+                population_records = records
+            else:
+                population_records = records[df[condition_column] == 1]
+            latest[name] = update_latest(latest[name], population_records)
 
-    return df_counts_all, df_counts_at_risk, df_counts_diabetes, df_counts_hypertension
+    return {name: create_table(df, demographics) for name, df in latest.items()}
 
 
 def get_path(*args):
@@ -81,6 +148,16 @@ def parse_args():
         help="List of strings representing variables to include",
     )
 
+    parser.add_argument(
+        "--partials_dir",
+        dest="partials_dir",
+        type=pathlib.Path,
+        default=None,
+        help="Directory of stored per-extract data, reused by reruns for "
+        "extracts that haven't changed. The data is patient level, so is not "
+        "stored by default",
+    )
+
     return parser.parse_args()
 
 
@@ -89,16 +166,7 @@ def main():
     paths = args.study_def_paths
     demographics = args.demographics.split(",")
 
-    table_total, table_at_risk, table_diabetes, table_hypertension = create_tables(
-        paths, demographics
-    )
-
-    tables = {
-        "total": table_total,
-        "at_risk": table_at_risk,
-        "diabetes": table_diabetes,
-        "hypertension": table_hypertension,
-    }
+    tables = create_tables(paths, demographics, args.partials_dir)
 
     for table_name, table in tables.items():
         pathlib.Path(get_path(OUTPUT_DIR, "pub/descriptive_tables")).mkdir(
@@ -1,7 +1,7 @@
 import pandas as pd
 from pathlib import Path
 from utilities import write_csv, OUTPUT_DIR
-from redaction_utils import create_top_5_code_table
+from redaction_utils import GROUP_LOW_COUNTS, create_top_5_code_table
 from variables import tests_extended
 
 codelist_dict = {
@@ -31,8 +31,8 @@ for test in tests_extended:
         code_df=codelist,
         code_column="code",
         term_column="term",
-        low_count_threshold=7,
-        rounding_base=5,
+        low_count_threshold=GROUP_LOW_COUNTS.threshold,
+        rounding_base=GROUP_LOW_COUNTS.rounding_base,
     )
     # create top 5 code table for publication if it doesn't exist
     Path(OUTPUT_DIR / "pub/top_5_tables").mkdir(parents=True, exist_ok=True)
@@ -51,7 +51,7 @@ for test in tests_extended:
         code_df=codelist_numeric,
         code_column="code",
         term_column="term",
-        low_count_threshold=7,
-        rounding_base=5,
+        low_count_threshold=GROUP_LOW_COUNTS.threshold,
+        rounding_base=GROUP_LOW_COUNTS.rounding_base,
     )
     write_csv(top_5_code_table_numeric,  OUTPUT_DIR / f"pub/top_5_tables/top_5_code_table_numeric_{test}.csv", index=False)
\ No newline at end of file
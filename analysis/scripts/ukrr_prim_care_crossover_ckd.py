@@ -1,13 +1,19 @@
 import pandas as pd
 import matplotlib.pyplot as plt
 from pathlib import Path
-from utilities import OUTPUT_DIR, plot_distribution_numeric_value
-from redaction_utils import drop_and_round, round_values
+from utilities import (
+    OUTPUT_DIR,
+    fill_missing,
+    plot_distribution_numeric_value,
+    read_extract,
+)
+from redaction_utils import ZERO_LOW_COUNTS, redact
+from rounding import round_values
 
 
 Path.mkdir(OUTPUT_DIR / "pub/ukrr_pc_overlap", parents=True, exist_ok=True)
 
-df = pd.read_csv(
+df = read_extract(
     OUTPUT_DIR / "joined/input_2020-12-01.csv.gz",
     usecols=[
         "ckd_primis_stage",
@@ -21,6 +27,11 @@ df = pd.read_csv(
         "creatinine_numeric_value_history",
     ],
 )
+# missing stages are counted as "Missing" in the overlap tables
+df["ckd_primis_stage"] = fill_missing(df["ckd_primis_stage"], "Missing")
+df["ckd_egfr_category"] = fill_missing(
+    df["ckd_egfr_category"], "Missing"
+).cat.add_categories("Uncategorised")
 
 # Drop anyone with stage 1 or 2 who dont have stage A2 or A3 for ACR results. set their egfr_category to Uncategorised
 df.loc[
@@ -41,11 +52,11 @@ stage_subset_encoded = pd.get_dummies(stage_subset)
 
 stage_subset_encoded = stage_subset_encoded.rename(
     columns={
-        "ckd_primis_stage_1.0": "Primary Care Stage 1",
-        "ckd_primis_stage_2.0": "Primary Care Stage 2",
-        "ckd_primis_stage_3.0": "Primary Care Stage 3",
-        "ckd_primis_stage_4.0": "Primary Care Stage 4",
-        "ckd_primis_stage_5.0": "Primary Care Stage 5",
+        "ckd_primis_stage_1": "Primary Care Stage 1",
+        "ckd_primis_stage_2": "Primary Care Stage 2",
+        "ckd_primis_stage_3": "Primary Care Stage 3",
+        "ckd_primis_stage_4": "Primary Care Stage 4",
+        "ckd_primis_stage_5": "Primary Care Stage 5",
         "ckd_primis_stage_Missing": "Primary Care Stage Missing",
         "ukrr_ckd2020_0": "Not in UKRR",
         "ukrr_ckd2020_1": "In UKRR",
@@ -56,7 +67,7 @@ stage_subset_encoded = stage_subset_encoded.rename(
 counts = stage_subset_encoded.groupby(
     by=stage_subset_encoded.columns.tolist()
 ).grouper.size()
-counts = drop_and_round(counts)
+counts, _ = redact(counts, ZERO_LOW_COUNTS)
 
 counts.to_csv(OUTPUT_DIR / "pub/ukrr_pc_overlap/ukrr_overlap_stage.csv")
 
@@ -85,7 +96,7 @@ counts = biochem_subset_encoded.groupby(
 ).grouper.size()
 
 
-counts = drop_and_round(counts)
+counts, _ = redact(counts, ZERO_LOW_COUNTS)
 
 counts.to_csv(OUTPUT_DIR / "pub/ukrr_pc_overlap/ukrr_overlap_biochem.csv")
 
@@ -107,11 +118,11 @@ stage_subset_encoded = pd.get_dummies(stage_subset)
 
 stage_subset_encoded = stage_subset_encoded.rename(
     columns={
-        "ckd_primis_stage_1.0": "Primary Care Stage 1",
-        "ckd_primis_stage_2.0": "Primary Care Stage 2",
-        "ckd_primis_stage_3.0": "Primary Care Stage 3",
-        "ckd_primis_stage_4.0": "Primary Care Stage 4",
-        "ckd_primis_stage_5.0": "Primary Care Stage 5",
+        "ckd_primis_stage_1": "Primary Care Stage 1",
+        "ckd_primis_stage_2": "Primary Care Stage 2",
+        "ckd_primis_stage_3": "Primary Care Stage 3",
+        "ckd_primis_stage_4": "Primary Care Stage 4",
+        "ckd_primis_stage_5": "Primary Care Stage 5",
         "ckd_primis_stage_Missing": "Primary Care Stage Missing",
         "in_ukrr_0": "Not in UKRR",
         "in_ukrr_1": "In UKRR",
@@ -121,7 +132,7 @@ stage_subset_encoded = stage_subset_encoded.rename(
 counts = stage_subset_encoded.groupby(
     by=stage_subset_encoded.columns.tolist()
 ).grouper.size()
-counts = drop_and_round(counts)
+counts, _ = redact(counts, ZERO_LOW_COUNTS)
 
 counts.to_csv(OUTPUT_DIR / "pub/ukrr_pc_overlap/ukrr_overlap_stage_combined.csv")
 
@@ -136,11 +147,11 @@ stage_subset_rrt_encoded = pd.get_dummies(stage_subset_rrt)
 
 stage_subset_rrt_encoded = stage_subset_rrt_encoded.rename(
     columns={
-        "ckd_primis_stage_1.0": "Primary Care Stage 1",
-        "ckd_primis_stage_2.0": "Primary Care Stage 2",
-        "ckd_primis_stage_3.0": "Primary Care Stage 3",
-        "ckd_primis_stage_4.0": "Primary Care Stage 4",
-        "ckd_primis_stage_5.0": "Primary Care Stage 5",
+        "ckd_primis_stage_1": "Primary Care Stage 1",
+        "ckd_primis_stage_2": "Primary Care Stage 2",
+        "ckd_primis_stage_3": "Primary Care Stage 3",
+        "ckd_primis_stage_4": "Primary Care Stage 4",
+        "ckd_primis_stage_5": "Primary Care Stage 5",
         "ckd_primis_stage_Missing": "Primary Care Stage Missing",
         "ukrr_2020_0": "Not in UKRR",
         "ukrr_2020_1": "In UKRR",
@@ -151,7 +162,7 @@ stage_subset_rrt_encoded = stage_subset_rrt_encoded.rename(
 counts = stage_subset_rrt_encoded.groupby(
     by=stage_subset_rrt_encoded.columns.tolist()
 ).grouper.size()
-counts = drop_and_round(counts)
+counts, _ = redact(counts, ZERO_LOW_COUNTS)
 
 counts.to_csv(OUTPUT_DIR / "pub/ukrr_pc_overlap/ukrr_rrt_overlap_stage.csv")
 
@@ -179,7 +190,7 @@ counts = biochem_subset_encoded.groupby(
     by=biochem_subset_encoded.columns.tolist()
 ).grouper.size()
 
-counts = drop_and_round(counts)
+counts, _ = redact(counts, ZERO_LOW_COUNTS)
 
 counts.to_csv(OUTPUT_DIR / "pub/ukrr_pc_overlap/ukrr_rrt_overlap_biochem.csv")
 
@@ -201,11 +212,11 @@ stage_subset_encoded = pd.get_dummies(stage_subset)
 
 stage_subset_encoded = stage_subset_encoded.rename(
     columns={
-        "ckd_primis_stage_1.0": "Primary Care Stage 1",
-        "ckd_primis_stage_2.0": "Primary Care Stage 2",
-        "ckd_primis_stage_3.0": "Primary Care Stage 3",
-        "ckd_primis_stage_4.0": "Primary Care Stage 4",
-        "ckd_primis_stage_5.0": "Primary Care Stage 5",
+        "ckd_primis_stage_1": "Primary Care Stage 1",
+        "ckd_primis_stage_2": "Primary Care Stage 2",
+        "ckd_primis_stage_3": "Primary Care Stage 3",
+        "ckd_primis_stage_4": "Primary Care Stage 4",
+        "ckd_primis_stage_5": "Primary Care Stage 5",
         "ckd_primis_stage_Missing": "Primary Care Stage Missing",
         "in_ukrr_0": "Not in UKRR",
         "in_ukrr_1": "In UKRR",
@@ -215,7 +226,7 @@ stage_subset_encoded = stage_subset_encoded.rename(
 counts = stage_subset_encoded.groupby(
     by=stage_subset_encoded.columns.tolist()
 ).grouper.size()
-counts = drop_and_round(counts)
+counts, _ = redact(counts, ZERO_LOW_COUNTS)
 
 counts.to_csv(OUTPUT_DIR / "pub/ukrr_pc_overlap/ukrr_rrt_overlap_stage_combined.csv")
 
@@ -231,7 +242,7 @@ prim_care_latest_egfr = df["egfr_numeric_value_history"][
     (df["ukrr_2020"].notnull())
     & (df["egfr_numeric_value_history"].notnull())
     & (df["egfr_numeric_value_history"] > 0)
-    & (df["ckd_primis_stage"] >= 4)
+    & (df["ckd_primis_stage"].isin(["4", "5"]))
     & ((df["ukrr_ckd2020_egfr"].notnull()) & (df["ukrr_ckd2020_egfr"] > 0))
 ]
 
@@ -256,18 +267,18 @@ prim_care_latest_creatinine = df["creatinine_numeric_value_history"][
     (df["ukrr_2020"].notnull())
     & (df["creatinine_numeric_value_history"].notnull())
     & (df["creatinine_numeric_value_history"] > 0)
-    & (df["ckd_primis_stage"] >= 4)
+    & (df["ckd_primis_stage"].isin(["4", "5"]))
     & ((df["ukrr_ckd2020_creat"].notnull()) & (df["ukrr_ckd2020_creat"] > 0))
 ]
 
 # table with the number of results in each category
 counts_table = pd.DataFrame(
     {
-        "egfr UKRR (n=)": [round(len(ukrr_latest_egfr) / 5) * 5],
-        "egfr Primary Care (n=)": [round(len(prim_care_latest_egfr) / 5) * 5],
-        "creatinine UKRR (n=)": [round(len(ukrr_latest_creatinine) / 5) * 5],
+        "egfr UKRR (n=)": [round_values(len(ukrr_latest_egfr))],
+        "egfr Primary Care (n=)": [round_values(len(prim_care_latest_egfr))],
+        "creatinine UKRR (n=)": [round_values(len(ukrr_latest_creatinine))],
         "creatinine Primary Care (n=)": [
-            round(len(prim_care_latest_creatinine) / 5) * 5
+            round_values(len(prim_care_latest_creatinine))
         ],
     }
 )
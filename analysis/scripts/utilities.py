@@ -1,11 +1,22 @@
+import ast
+import hashlib
+import inspect
+import math
+import os
 import re
 import seaborn as sns
 import matplotlib
 import matplotlib.pyplot as plt
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
 import numpy as np
 import pandas as pd
 from pathlib import Path
-from redaction_utils import compute_deciles
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache
+from redaction_utils import ZERO_LOW_COUNTS, compute_deciles, redact
+from schema import get_extract_schema
 
 BASE_DIR = Path(__file__).parents[1]
 OUTPUT_DIR = BASE_DIR / "../output"
@@ -25,6 +36,15 @@ UPPER_CENTER = 9
 CENTER = 10
 
 
+# rows per chunk when reading cohort extracts with iter_extract
+CHUNKSIZE = 100_000
+
+# part of the key of every stored partial (see cached_partial): bump it to invalidate
+# them all, e.g. when a dependency outside analysis/scripts changes how extracts are
+# read
+PARTIALS_VERSION = 1
+
+
 def match_input_files(file: str) -> bool:
     """Checks if file name has format outputted by cohort extractor"""
     pattern = r"^input_20\d\d-(0[1-9]|1[012])-(0[1-9]|[12][0-9]|3[01])\.csv.gz"
@@ -42,6 +62,380 @@ def get_date_input_file(file: str) -> str:
         return date.group(1)
 
 
+def file_digest(path) -> str:
+    """Returns the sha256 hex digest of the contents of a file"""
+    stat = os.stat(path)
+    return _file_digest(str(Path(path).resolve()), stat.st_size, stat.st_mtime_ns)
+
+
+@lru_cache(maxsize=None)
+def _file_digest(path, size, mtime_ns):
+    # size and modification time are part of the cache key so that a file that
+    # changes is hashed again
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def get_module_dependencies(path) -> list:
+    """Gets the paths of a module and of the modules in its directory that it
+    imports, directly or indirectly, sorted"""
+    path = Path(path).resolve()
+    dependencies = set()
+    pending = [path]
+    while pending:
+        module_path = pending.pop()
+        if module_path in dependencies:
+            continue
+        dependencies.add(module_path)
+
+        for node in ast.walk(ast.parse(module_path.read_text())):
+            if isinstance(node, ast.Import):
+                names = [alias.name for alias in node.names]
+            elif isinstance(node, ast.ImportFrom) and node.level == 0:
+                names = [node.module]
+            else:
+                continue
+            # the analysis scripts import each other by module name
+            for name in names:
+                imported_path = path.parent / f"{name}.py"
+                if imported_path.exists():
+                    pending.append(imported_path)
+
+    return sorted(dependencies)
+
+
+def get_source_digest(func) -> str:
+    """Gets a digest of the source of the module defining func and of the modules it
+    imports from the same directory, which func's results may depend on"""
+    digest = hashlib.sha256()
+    for path in get_module_dependencies(inspect.getsourcefile(func)):
+        digest.update(f"{path.name}:{file_digest(path)}".encode())
+    return digest.hexdigest()
+
+
+def cached_partial(path, func, store_dir=None, **kwargs):
+    """Computes the partial result func(path, **kwargs) of a single cohort extract,
+    storing it in store_dir. Stored results are keyed by the extract's file name and
+    content digest, by func, the source of its module and of the modules it
+    imports (see get_source_digest), by kwargs, PARTIALS_VERSION and the extract
+    dtypes, so a rerun only computes the partials of new or changed extracts.
+    Args:
+        path: Path to the cohort extract.
+        func: Module level function of an extract path returning a picklable result.
+        store_dir: Directory of stored partials. If None, the result is computed
+            and not stored.
+        **kwargs: Further arguments to func.
+    Returns:
+        The partial result.
+    """
+    if store_dir is None:
+        return func(path, **kwargs)
+
+    key = repr(
+        (
+            PARTIALS_VERSION,
+            func.__qualname__,
+            get_source_digest(func),
+            get_schema_digest(),
+            sorted(kwargs.items()),
+        )
+    )
+    key_digest = hashlib.sha256(key.encode()).hexdigest()[:16]
+    name = Path(path).name.split(".")[0]
+    store_dir = Path(store_dir)
+    store_path = store_dir / f"{name}.{key_digest}.{file_digest(path)[:16]}.pickle"
+
+    if store_path.exists():
+        return pd.read_pickle(store_path)
+
+    result = func(path, **kwargs)
+
+    # drop the partials of previous versions of the extract
+    for stale_path in store_dir.glob(f"{name}.{key_digest}.*.pickle"):
+        stale_path.unlink()
+
+    # write then rename, so an interrupted run doesn't leave a partial behind
+    store_dir.mkdir(parents=True, exist_ok=True)
+    tmp_path = store_path.with_suffix(f".{os.getpid()}.tmp")
+    pd.to_pickle(result, tmp_path)
+    os.replace(tmp_path, store_path)
+    return result
+
+
+def get_columnar_path(path) -> Path:
+    """Gets the path of the columnar (feather) copy of a cohort extract,
+    e.g. output/joined/columnar/input_2020-01-01.feather"""
+    path = Path(path)
+    return path.parent / "columnar" / path.name.replace(".csv.gz", ".feather")
+
+
+def get_extract_dtypes(path, usecols=None):
+    """Gets the read_csv `dtype` and `parse_dates` arguments for the columns of a
+    joined cohort extract, from the types declared in the study definitions."""
+    dtype, parse_dates = get_extract_schema()
+
+    columns = set(pd.read_csv(path, nrows=0).columns)
+    if usecols is not None:
+        columns &= set(usecols)
+
+    return (
+        {column: t for column, t in dtype.items() if column in columns},
+        [column for column in parse_dates if column in columns],
+    )
+
+
+def write_columnar(path, columnar_path=None):
+    """Converts a cohort extract to a typed columnar (feather) file, with the
+    dtypes declared in the study definitions. A digest of those dtypes and the
+    size, modification time and digest of the source file are stored in the file
+    metadata so that stale copies can be detected.
+    Args:
+        path: Path to the cohort extract (csv.gz).
+        columnar_path: Path to write to. Defaults to get_columnar_path(path).
+    Returns:
+        The path written to.
+    """
+    import pyarrow as pa
+    import pyarrow.feather as feather
+
+    columnar_path = Path(columnar_path or get_columnar_path(path))
+    columnar_path.parent.mkdir(parents=True, exist_ok=True)
+
+    dtype, parse_dates = get_extract_dtypes(path)
+    df = pd.read_csv(path, dtype=dtype, parse_dates=parse_dates)
+
+    stat = os.stat(path)
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    table = table.replace_schema_metadata(
+        {
+            **table.schema.metadata,
+            b"schema_digest": get_schema_digest().encode(),
+            b"source_size": str(stat.st_size).encode(),
+            b"source_mtime_ns": str(stat.st_mtime_ns).encode(),
+            b"source_digest": file_digest(path).encode(),
+        }
+    )
+    # record batches of CHUNKSIZE rows can be read one at a time by iter_extract
+    feather.write_feather(table, columnar_path, chunksize=CHUNKSIZE)
+    return columnar_path
+
+
+def get_schema_digest() -> str:
+    """Gets a digest of the extract dtypes declared in the study definitions"""
+    return hashlib.sha256(repr(get_extract_schema()).encode()).hexdigest()
+
+
+def is_current_columnar(path, metadata):
+    """Checks if a columnar copy with the given metadata was converted from the
+    current contents of the extract, with the current dtypes. The extract is only
+    hashed if its size or modification time differ from those the copy was
+    converted from."""
+    if metadata.get(b"schema_digest", b"").decode() != get_schema_digest():
+        return False
+
+    stat = os.stat(path)
+    if metadata.get(b"source_size") == str(stat.st_size).encode() and metadata.get(
+        b"source_mtime_ns"
+    ) == str(stat.st_mtime_ns).encode():
+        return True
+    return metadata.get(b"source_digest", b"").decode() == file_digest(path)
+
+
+@contextmanager
+def open_columnar(path, columns=None):
+    """Opens the columnar copy of a cohort extract if it exists and was converted
+    from the current contents of the extract. The copy is closed on leaving the
+    with block, so batches read from it must be converted first.
+    Args:
+        path: Path to the cohort extract (csv.gz).
+        columns: Columns to read. Defaults to all columns.
+    Yields:
+        A pyarrow RecordBatchFileReader which only reads the given columns, or
+        None if there is no up to date copy.
+    """
+    columnar_path = get_columnar_path(path)
+    if not columnar_path.exists():
+        yield None
+        return
+
+    try:
+        import pyarrow as pa
+    except ImportError:
+        yield None
+        return
+
+    with pa.memory_map(str(columnar_path)) as source:
+        schema = pa.ipc.open_file(source).schema
+        if not is_current_columnar(path, schema.metadata or {}):
+            yield None
+            return
+
+        # keep the column order of the extract, as pd.read_csv does with usecols
+        options = None
+        if columns is not None:
+            options = pa.ipc.IpcReadOptions(
+                included_fields=[
+                    i for i, column in enumerate(schema.names) if column in set(columns)
+                ]
+            )
+        yield pa.ipc.open_file(source, options=options)
+
+
+def read_columnar(path, columns=None):
+    """Reads the columnar copy of a cohort extract if it is up to date, else
+    returns None."""
+    with open_columnar(path, columns) as reader:
+        if reader is None:
+            return None
+        return reader.read_pandas()
+
+
+def read_extract(path, usecols=None):
+    """Reads a joined cohort extract with the dtypes declared in the study
+    definitions (see schema.py). Reads its columnar copy when it is up to date,
+    falling back to the csv otherwise.
+    Args:
+        path: Path to the cohort extract (csv.gz).
+        usecols: Columns to read. Defaults to all columns.
+    Returns:
+        A DataFrame.
+    """
+    df = read_columnar(path, columns=usecols)
+
+    if df is None:
+        dtype, parse_dates = get_extract_dtypes(path, usecols)
+        df = pd.read_csv(path, usecols=usecols, dtype=dtype, parse_dates=parse_dates)
+
+    return df
+
+
+def iter_extract(path, usecols=None, where=None, chunksize=CHUNKSIZE):
+    """Reads a joined cohort extract in chunks, so that memory use is bounded by
+    the chunk size rather than the size of the extract. Chunks have the same
+    dtypes as read_extract, but categories may differ between chunks.
+    Args:
+        path: Path to the cohort extract (csv.gz).
+        usecols: Columns to read. Defaults to all columns.
+        where: Optional function of a chunk returning a boolean mask of the rows
+            to keep, e.g. lambda df: df["at_risk"] == 1.
+        chunksize: Number of rows per chunk read from the csv. Chunks of the
+            columnar copy are the record batches it was written with.
+    Yields:
+        DataFrames.
+    """
+    with open_columnar(path, columns=usecols) as reader:
+        if reader is None:
+            dtype, parse_dates = get_extract_dtypes(path, usecols)
+            chunks = pd.read_csv(
+                path,
+                usecols=usecols,
+                dtype=dtype,
+                parse_dates=parse_dates,
+                chunksize=chunksize,
+            )
+        else:
+            chunks = (
+                reader.get_batch(i).to_pandas()
+                for i in range(reader.num_record_batches)
+            )
+
+        for chunk in chunks:
+            if where is not None:
+                chunk = chunk.loc[where(chunk), :]
+            yield chunk
+
+
+def sum_by_flag(path, columns, flags, where_column=None):
+    """Sums columns of a cohort extract for the rows with and without a flag, where
+    the flag depends on the year of the extract. Only the columns needed are read,
+    in chunks.
+    Args:
+        path: Path to the cohort extract (input_YYYY-MM-DD.csv.gz).
+        columns: Columns to sum.
+        flags: Dict of year (YYYY) to the flag column to group by in that year.
+        where_column: Optional binary flag; only rows where it is 1 are summed.
+    Returns:
+        A DataFrame indexed by the flag (0 and 1), with the sum of each column and
+        the number of rows (count), which are 0 for an empty extract. Rows missing
+        the flag are in neither.
+    """
+    flag = flags[get_date_input_file(Path(path).name)[:4]]
+    usecols = list(columns) + [flag]
+    where = None
+    if where_column is not None:
+        usecols.append(where_column)
+        where = lambda df: df[where_column] == 1
+
+    sums = []
+    for df in iter_extract(path, usecols=usecols, where=where):
+        groups = df.groupby(flag)
+        sums.append(groups[list(columns)].sum().assign(count=groups.size()))
+
+    if not sums:
+        # an extract without any rows
+        return pd.DataFrame(0, index=[0, 1], columns=list(columns) + ["count"])
+    return pd.concat(sums).groupby(level=0).sum().reindex([0, 1], fill_value=0)
+
+
+def fill_missing(column, value):
+    """Fills missing values of a column with value. For categorical columns, value is
+    added to the categories first."""
+    if isinstance(column.dtype, pd.CategoricalDtype):
+        if value not in column.cat.categories:
+            column = column.cat.add_categories(value)
+    return column.fillna(value)
+
+
+def default_workers() -> int:
+    """Number of worker processes to use by default: the cores available to this process"""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def parallel_map(func, iterable, workers=None):
+    """Applies func to each item in a pool of worker processes, returning the
+    results in input order. Runs in the current process if workers is 1.
+    Args:
+        func: A picklable (module level) function.
+        iterable: Items to apply func to.
+        workers: Number of worker processes. Defaults to the available cores.
+    Returns:
+        A list of results, in the same order as iterable.
+    """
+    items = list(iterable)
+    workers = min(workers or default_workers(), len(items))
+
+    if workers <= 1:
+        return [func(item) for item in items]
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(func, items))
+
+
+def read_measure(measure_id, measures_dir=OUTPUT_DIR / "joined"):
+    """Reads a measure table, parsing its dates and reading text group columns as
+    categories.
+    Args:
+        measure_id: Id of the measure, e.g. "eGFR_stage_population_rate".
+        measures_dir: Directory of the measure tables.
+    Returns:
+        The measure table.
+    """
+    df = pd.read_csv(
+        Path(measures_dir) / f"measure_{measure_id}.csv", parse_dates=["date"]
+    )
+    # the columns before numerator, denominator, value and date are the group_by
+    for column in df.columns[:-4]:
+        if df[column].dtype == object:
+            df[column] = df[column].astype("category")
+    return df
+
+
 def drop_irrelevant_practices(df):
     """Drops irrelevant practices from the given measure table.
     An irrelevant practice has zero events during the study period.
@@ -54,6 +448,52 @@ def drop_irrelevant_practices(df):
     return df[df.practice.isin(is_relevant[is_relevant == True].index)]
 
 
+def figure_spec(draw, filename, figsize=None, **kwargs):
+    """Specifies a figure to be rendered by render_figure.
+    Args:
+        draw: Module level function draw(fig, **kwargs) drawing on a new Figure.
+        filename: Path the figure is saved to.
+        figsize: Size of the figure in inches. Defaults to the rcParams size.
+        **kwargs: The data and styling passed to draw.
+    Returns:
+        A picklable figure specification, which includes the current rcParams (e.g.
+        a seaborn style) so the figure renders the same in any process.
+    """
+    rc = {key: value for key, value in matplotlib.rcParams.items() if key != "backend"}
+    return (draw, filename, figsize, kwargs, rc)
+
+
+def render_figure(spec):
+    """Renders a figure specification with matplotlib's object-oriented Agg API"""
+    draw, filename, figsize, kwargs, rc = spec
+    with matplotlib.rc_context(rc):
+        fig = Figure(figsize=figsize)
+        FigureCanvasAgg(fig)
+        draw(fig, **kwargs)
+        fig.savefig(filename)
+
+
+def render_figures(specs, workers=None):
+    """Renders figure specifications in a process pool.
+    Args:
+        specs: Figure specifications from figure_spec.
+        workers: Number of processes. Defaults to the available cores.
+    """
+    # a file specified more than once is rendered from its last specification, as
+    # if the figures were rendered in order
+    last_specs = {str(spec[1]): spec for spec in specs}
+    parallel_map(render_figure, last_specs.values(), workers=workers)
+
+
+def queue_figure(spec, queue=None):
+    """Adds a figure specification to a queue, or renders it now if there's no
+    queue"""
+    if queue is None:
+        render_figure(spec)
+    else:
+        queue.append(spec)
+
+
 def deciles_chart(
     df,
     filename,
@@ -63,16 +503,35 @@ def deciles_chart(
     count_column=None,
     title="",
     ylabel="",
+    queue=None,
 ):
     """period_column must be dates / datetimes"""
 
     df = compute_deciles(df, period_column, column, has_outer_percentiles=False)
     df.to_csv(data_filename, index=False)
 
+    # a (period x percentile) table of the deciles, so that all the lines of a
+    # style are drawn by one plot call
+    deciles = df.pivot(index=period_column, columns="percentile", values=column)
+
     """period_column must be dates / datetimes"""
     sns.set_style("whitegrid", {"grid.color": ".9"})
 
-    fig, ax = plt.subplots(1, 1)
+    spec = figure_spec(
+        draw_deciles_chart,
+        filename,
+        deciles=deciles,
+        title=title,
+        ylabel=ylabel,
+        ymax=100 if df[column].isnull().values.all() else df[column].max() * 1.05,
+        xlim=[df[period_column].min(), df[period_column].max()],
+        xticks=sorted(df[period_column].unique()),
+    )
+    queue_figure(spec, queue)
+
+
+def draw_deciles_chart(fig, deciles, title, ylabel, ymax, xlim, xticks):
+    ax = fig.add_subplot()
 
     linestyles = {
         "decile": {
@@ -85,55 +544,33 @@ def deciles_chart(
             "linewidth": 1.5,
             "label": "Median",
         },
-        "percentile": {
-            "line": "b:",
-            "linewidth": 0.8,
-            "label": "1st-9th, 91st-99th percentile",
-        },
     }
-    label_seen = []
-    for percentile in range(1, 100):  # plot each decile line
-        data = df[df["percentile"] == percentile]
-        add_label = False
-
-        if percentile == 50:
-            style = linestyles["median"]
-            add_label = True
-
-        else:
-            style = linestyles["decile"]
-            if "decile" not in label_seen:
-                label_seen.append("decile")
-                add_label = True
-        if add_label:
-            label = style["label"]
-        else:
-            label = "_nolegend_"
-
-        ax.plot(
-            data[period_column],
-            data[column],
+    for name, percentiles in [
+        ("decile", [p for p in deciles.columns if p != 50]),
+        ("median", [50]),
+    ]:
+        style = linestyles[name]
+        lines = ax.plot(
+            deciles.index,
+            deciles[percentiles].to_numpy(),
             style["line"],
             linewidth=style["linewidth"],
-            label=label,
         )
+        # label one line of each style, for the legend
+        lines[0].set_label(style["label"])
+
     ax.set_ylabel(ylabel, size=15, alpha=0.6)
     if title:
         ax.set_title(title, size=14, wrap=True)
     # set ymax across all subplots as largest value across dataset
 
-    ax.set_ylim(
-        [0, 100 if df[column].isnull().values.all() else df[column].max() * 1.05]
-    )
+    ax.set_ylim([0, ymax])
     ax.tick_params(labelsize=8)
-    ax.set_xlim(
-        [df[period_column].min(), df[period_column].max()]
-    )  # set x axis range as full date range
+    ax.set_xlim(xlim)  # set x axis range as full date range
 
-    plt.setp(ax.xaxis.get_majorticklabels(), rotation=90)
     ax.xaxis.set_major_formatter(matplotlib.dates.DateFormatter("%B %Y"))
-
-    plt.xticks(sorted(df[period_column].unique()), rotation=90)
+    ax.set_xticks(xticks)
+    plt.setp(ax.xaxis.get_majorticklabels(), rotation=90)
 
     ax.legend(
         bbox_to_anchor=(1.1, 0.8),  # arbitrary location in axes
@@ -146,9 +583,7 @@ def deciles_chart(
     )  # padding between the axes and legend
     #  specified in font-size units
 
-    plt.tight_layout()
-    plt.savefig(filename)
-    plt.clf()
+    fig.tight_layout()
 
 
 def plot_measures(
@@ -159,6 +594,7 @@ def plot_measures(
     y_label: str,
     as_bar: bool = False,
     category: str = None,
+    queue: list = None,
 ):
     """Produce time series plot from measures table.  One line is plotted for each sub
     category within the category column. Saves output in 'output' dir as jpeg file.
@@ -169,45 +605,62 @@ def plot_measures(
         y_label: Label to use for y-axis
         as_bar: Boolean indicating if bar chart should be plotted instead of line chart. Only valid if no categories.
         category: Name of column indicating different categories
+        queue: List the figure specification is added to, to be rendered later by
+            render_figures. If None, the figure is rendered now.
     """
-    plt.figure(figsize=(15, 8))
+    lines = []
+    legend = None
     if category:
         df[category] = df[category].fillna("Missing").astype(str)
-        for unique_category in sorted(df[category].unique()):
+        legend = sorted(df[category].unique())
+        for unique_category in legend:
             # subset on category column and sort by date
             df_subset = df[df[category] == unique_category].sort_values("date")
 
-            plt.plot(df_subset["date"], df_subset[column_to_plot])
+            lines.append((df_subset["date"], df_subset[column_to_plot]))
     else:
-        if as_bar:
-            df.plot.bar("date", column_to_plot, legend=False)
-        else:
-            plt.plot(df["date"], df[column_to_plot])
-
-    x_labels = sorted(df["date"].unique())
-
-    plt.ylabel(y_label)
-    plt.xlabel("Date")
-    plt.xticks(x_labels, rotation="vertical")
-    plt.title(title)
-    plt.ylim(
-        bottom=0,
-        top=100
+        lines.append((df["date"], df[column_to_plot]))
+
+    spec = figure_spec(
+        draw_measures,
+        OUTPUT_DIR / f"{filename}.jpeg",
+        figsize=(15, 8),
+        lines=lines,
+        as_bar=as_bar,
+        x_labels=sorted(df["date"].unique()),
+        title=title,
+        y_label=y_label,
+        ymax=100
         if df[column_to_plot].isnull().values.all()
         else df[column_to_plot].max() * 1.05,
+        legend=legend,
     )
+    queue_figure(spec, queue)
 
-    if category:
-        plt.legend(
-            sorted(df[category].unique()), bbox_to_anchor=(1.04, 1), loc="upper left"
-        )
 
-    plt.tight_layout()
-    plt.margins(x=0)
-    plt.grid(True)
+def draw_measures(fig, lines, as_bar, x_labels, title, y_label, ymax, legend):
+    ax = fig.add_subplot()
+    for x, y in lines:
+        if as_bar:
+            pd.DataFrame({"date": x, "value": y}).plot.bar(
+                "date", "value", legend=False, ax=ax
+            )
+        else:
+            ax.plot(x, y)
 
-    plt.savefig(OUTPUT_DIR / f"{filename}.jpeg")
-    plt.close()
+    ax.set_ylabel(y_label)
+    ax.set_xlabel("Date")
+    ax.set_xticks(x_labels)
+    plt.setp(ax.get_xticklabels(), rotation="vertical")
+    ax.set_title(title)
+    ax.set_ylim(bottom=0, top=ymax)
+
+    if legend:
+        ax.legend(legend, bbox_to_anchor=(1.04, 1), loc="upper left")
+
+    fig.tight_layout()
+    ax.margins(x=0)
+    ax.grid(True)
 
 
 def plot_boxplot_numeric_value(x, title, filename):
@@ -219,6 +672,19 @@ def plot_boxplot_numeric_value(x, title, filename):
     plt.clf()
 
 
+def get_histogram_bins(start, end, bin_width):
+    """Gets the bin edges of a histogram from start to end"""
+    return np.arange(start, end + bin_width, bin_width)
+
+
+def histogram_counts(x, start, end, bin_width):
+    """Counts the values between start and end (inclusive) in each bin of width
+    bin_width from start. Counts of separate arrays can be summed."""
+    x = x[(x >= start) & (x <= end)]
+    counts, _ = np.histogram(x, bins=get_histogram_bins(start, end, bin_width))
+    return counts
+
+
 def plot_distribution_numeric_value(
     x, title, filename, start, end, bin_width, combined=False
 ):
@@ -235,53 +701,53 @@ def plot_distribution_numeric_value(
         combined (bool): If True, multiple distributions can be combined in the same plot.
 
     """
-    plt.figure(figsize=(10, 6))
+    if combined:
+        counts = {
+            label: histogram_counts(data, start, end, bin_width)
+            for label, data in x.items()
+        }
+    else:
+        counts = histogram_counts(x, start, end, bin_width)
 
-    bins = np.arange(start, end + bin_width, bin_width)
+    plot_distribution_counts(counts, title, filename, start, end, bin_width, combined)
 
-    if combined:
-        for label, data in x.items():
-            data = data[(data >= start) & (data <= end)]
-            counts, bin_edges = np.histogram(data, bins=bins)
 
-            counts[counts <= 7] = 0
-            counts = 5 * np.round(counts / 5)
+def plot_distribution_counts(
+    counts, title, filename, start, end, bin_width, combined=False
+):
+    """Plots a histogram from the counts of each bin (see histogram_counts), showing
+    relative frequencies, and writes the redacted counts and relative frequencies
+    of each bin.
 
-            if counts.sum() > 0:
-                relative_frequencies = np.round(counts / counts.sum(), 2)
+    Args:
+        counts (array): Count of each bin, or with combined, a dict of label to
+            counts.
+        title (str): Title of the plot.
+        filename (str): Output filename.
+        start (float): Start value of the bins.
+        end (float): End value of the bins.
+        bin_width (float): Width of each bin.
+        combined (bool): If True, multiple distributions can be combined in the same plot.
 
-            else:
-                relative_frequencies = np.zeros(len(counts))
-
-            plt.bar(
-                bin_edges[:-1],
-                relative_frequencies,
-                width=bin_width,
-                align="edge",
-                alpha=0.5,
-            )
+    """
+    plt.figure(figsize=(10, 6))
 
-            df = pd.DataFrame(
-                {
-                    "Bin_Edges": bin_edges[:-1],
-                    "Counts": counts,
-                    "Relative_Frequencies": relative_frequencies,
-                }
-            )
+    bin_edges = get_histogram_bins(start, end, bin_width)
 
-            df.to_csv(OUTPUT_DIR / f"{filename}_{label}_data.csv", index=False)
+    if combined:
+        labelled_counts = counts.items()
     else:
-        x = x[(x >= start) & (x <= end)]
-        counts, bin_edges = np.histogram(x, bins=bins)
+        labelled_counts = [(None, counts)]
 
-        counts[counts <= 7] = 0
-        counts = 5 * np.round(counts / 5)
+    for label, label_counts in labelled_counts:
+        label_counts = redact(pd.Series(label_counts), ZERO_LOW_COUNTS)[0]
+        label_counts = label_counts.to_numpy(float)
 
-        if counts.sum() > 0:
-            relative_frequencies = np.round(counts / counts.sum(), 2)
+        if label_counts.sum() > 0:
+            relative_frequencies = np.round(label_counts / label_counts.sum(), 2)
 
         else:
-            relative_frequencies = np.zeros(len(counts))
+            relative_frequencies = np.zeros(len(label_counts))
 
         # plot the relative frequencies as bar
         plt.bar(
@@ -295,12 +761,15 @@ def plot_distribution_numeric_value(
         df = pd.DataFrame(
             {
                 "Bin_Edges": bin_edges[:-1],
-                "Counts": counts,
+                "Counts": label_counts,
                 "Relative_Frequencies": relative_frequencies,
             }
         )
 
-        df.to_csv(OUTPUT_DIR / f"{filename}_data.csv", index=False)
+        if combined:
+            df.to_csv(OUTPUT_DIR / f"{filename}_{label}_data.csv", index=False)
+        else:
+            df.to_csv(OUTPUT_DIR / f"{filename}_data.csv", index=False)
 
     plt.title(title)
     plt.xlabel("Numeric Value")
@@ -308,7 +777,7 @@ def plot_distribution_numeric_value(
     plt.legend()
 
     if combined:
-        plt.legend(x.keys())
+        plt.legend(counts.keys())
     plt.grid(True)
     plt.margins(x=0)
     plt.xlim(left=start)
@@ -369,21 +838,136 @@ def ckd_epi(sex, age, creatinine, creatinine_date, date_lim):
         return None
 
 
-def update_df(original_df, new_df, columns=[], on="patient_id"):
-    updated = original_df.merge(
-        new_df, on=on, how="outer", suffixes=("_old", "_new"), indicator=True
+# sex multipliers of the calculators
+COCKCROFT_GAULT_MULTIPLIERS = {"F": 0.85, "M": 1}
+CKD_EPI_MULTIPLIERS = {"F": (0.7, -0.241), "M": (0.9, -0.302)}
+
+
+def python_power(base, exponent):
+    """Raises base to exponent elementwise with Python's float power.
+
+    numpy's power isn't bitwise identical to the C library pow that Python uses, so
+    the power of each distinct (base, exponent) pair is computed once in Python and
+    broadcast back.
+    Args:
+        base: Scalar or array of floats.
+        exponent: Scalar or array of floats.
+    Returns:
+        An array of floats.
+    """
+    base, exponent = np.broadcast_arrays(
+        np.asarray(base, dtype=float), np.asarray(exponent, dtype=float)
     )
+    pairs = np.stack([base.ravel(), exponent.ravel()], axis=1)
+    if len(pairs) == 0:
+        return np.empty(base.shape)
+    values, inverse = np.unique(pairs, axis=0, return_inverse=True)
+    powers = np.array([b**e for b, e in values.tolist()])
+    return powers[inverse.ravel()].reshape(base.shape)
 
-    for c in columns:
-        updated[c] = np.nan
-        updated.loc[updated["_merge"] == "left_only", c] = updated[f"{c}_old"]
-        updated.loc[updated["_merge"] != "left_only", c] = updated[f"{c}_new"]
-        updated = updated.drop([f"{c}_old", f"{c}_new"], axis=1)
-    updated = updated.drop(["_merge"], axis=1)
-    return updated
 
+def cockcroft_gault_series(
+    sex, age, weight, weight_date, creatinine, creatinine_date, date_lim
+):
+    """Calculates cockcroft_gault for whole columns of patients.
+    Args:
+        sex, age, weight, creatinine: Series of patient values.
+        weight_date, creatinine_date: Series of measurement datetimes.
+        date_lim: Date that both measurements must be after.
+    Returns:
+        A float Series, missing where a measurement is not after date_lim, sex is
+        not "F" or "M" or creatinine is zero.
+    """
+    date_lim = pd.to_datetime(date_lim)
+    multiplier = sex.map(COCKCROFT_GAULT_MULTIPLIERS).astype(float)
+
+    valid = (
+        (date_lim < weight_date)
+        & (date_lim < creatinine_date)
+        & multiplier.notna()
+        & (creatinine != 0.0)
+    )
+    cg = ((140 - age) * weight * multiplier) / (72 * creatinine)
+    return cg.where(valid)
+
+
+def ckd_epi_series(sex, age, creatinine, creatinine_date, date_lim):
+    """Calculates ckd_epi for whole columns of patients.
+
+    As in ckd_epi, creatinine is divided by the exponent of the sex multiplier, so
+    positive creatinine values give (Python's principal) complex powers.
+    Args:
+        sex, age, creatinine: Series of patient values.
+        creatinine_date: Series of creatinine measurement datetimes.
+        date_lim: Date that the creatinine measurement must be after.
+    Returns:
+        A Series, complex if any value is complex and float otherwise, missing
+        where the measurement is not after date_lim, sex is not "F" or "M" or
+        creatinine is zero.
+    """
+    date_lim = pd.to_datetime(date_lim)
+    ckd = pd.Series(None, index=sex.index, dtype=object)
+    valid = (date_lim < creatinine_date) & (creatinine != 0.0)
+
+    for sex_value, (multiplier, exponent) in CKD_EPI_MULTIPLIERS.items():
+        rows = valid & (sex == sex_value)
+        base = creatinine[rows].to_numpy(dtype=float) / exponent
+
+        # min([1, base]) and max([1, base]) are 1 when base is missing
+        low = np.where(base < 1, base, 1.0)
+        high = np.where(base > 1, base, 1.0)
+
+        # a negative float to a fractional power has modulus |low| ** exponent
+        # and phase pi * exponent
+        negative = low < 0
+        modulus = python_power(np.abs(low), exponent)
+        phase = math.atan2(0.0, -1.0) * exponent
+        real = np.where(negative, modulus * math.cos(phase), modulus)
+        imag = np.where(negative, modulus * math.sin(phase), 0.0)
+
+        factor = python_power(high, -1.200)
+        age_factor = python_power(0.9938, age[rows].to_numpy())
+        real = 142 * real * factor * age_factor * multiplier
+        imag = 142 * imag * factor * age_factor * multiplier
+
+        complex_values = np.empty(len(real), dtype=complex)
+        complex_values.real = real
+        complex_values.imag = imag
+        ckd[rows] = np.where(
+            negative, complex_values.astype(object), real.astype(object)
+        )
+
+    return ckd.infer_objects()
+
+
+def update_latest(latest, new, on="patient_id"):
+    """Updates the latest record of each patient with the records of a later extract.
+    Args:
+        latest: The latest record of each patient so far, or None.
+        new: Records of a later extract, one per patient.
+        on: Name of the patient id column.
+    Returns:
+        The records of new, followed by those of latest for patients not in new.
+        Categorical columns stay categorical, with the categories of both.
+    """
+    if latest is None:
+        return new
+    latest = latest[~latest[on].isin(new[on])]
+
+    for column in new.columns:
+        new_categorical = isinstance(new[column].dtype, pd.CategoricalDtype)
+        latest_categorical = isinstance(latest[column].dtype, pd.CategoricalDtype)
+        if (
+            new_categorical
+            and latest_categorical
+            and not new[column].cat.categories.equals(latest[column].cat.categories)
+        ):
+            categories = new[column].cat.categories.union(
+                latest[column].cat.categories
+            )
+            new = new.assign(**{column: new[column].cat.set_categories(categories)})
+            latest = latest.assign(
+                **{column: latest[column].cat.set_categories(categories)}
+            )
 
-def round_value(x, divisor=None):
-    if divisor:
-        return int(round(x / divisor) * divisor)
-    return int(round(x))
+    return pd.concat([new, latest], ignore_index=True)
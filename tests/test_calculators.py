@@ -0,0 +1,36 @@
+import pandas as pd
+import pytest
+
+from analysis.scripts.calculators import CREATININE_MG_DL, evaluate_calculators
+
+
+def test_evaluate_calculators():
+    df = pd.DataFrame(
+        {
+            "sex": ["F", "F", "U", "M"],
+            "age": [50, 50, 50, 50],
+            "creatinine_numeric_value": [0.8 / CREATININE_MG_DL, 0, 70, None],
+            "height_numeric_value": [120, 120, 120, 120],
+        }
+    )
+
+    calculated = evaluate_calculators(df)
+
+    assert calculated["ckd_epi_2021"][0] == pytest.approx(89.707, abs=1e-3)
+    assert calculated["ckd_epi_2009"][0] == pytest.approx(85.964, abs=1e-3)
+    assert calculated["mdrd"][0] == pytest.approx(75.925, abs=1e-3)
+    assert calculated["schwartz"][0] == pytest.approx(61.95, abs=1e-3)
+    assert calculated["ckd_epi_2021_g_category"].tolist()[0] == "G2"
+    assert calculated["mdrd_g_category"].tolist()[0] == "G2"
+
+    # zero or missing creatinine and unknown sex are not calculated
+    assert calculated.loc[1:, "ckd_epi_2021"].isna().all()
+    assert calculated.loc[1:, "ckd_epi_2021_g_category"].isna().all()
+
+
+def test_evaluate_calculators_missing_columns():
+    df = pd.DataFrame({"sex": ["F"], "age": [50], "creatinine_numeric_value": [70]})
+
+    assert "schwartz" not in evaluate_calculators(df)
+    with pytest.raises(ValueError):
+        evaluate_calculators(df, ["schwartz"])
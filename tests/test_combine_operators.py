@@ -1,9 +1,14 @@
+import numpy as np
 import pandas as pd
 
-from pandas._testing import assert_frame_equal
+from pandas._testing import assert_frame_equal, assert_series_equal
 from analysis.scripts.combine_operators import (
 
     convert_values,
+    map_numeric_values,
+    count_file,
+    count_tests,
+    combine_counts,
 )
     
 def test_map_numeric_values():
@@ -29,4 +34,91 @@ def test_map_numeric_values():
 
     result = convert_values(test_data, "albumin", mapping)
 
-    assert_frame_equal(result, expected)
\ No newline at end of file
+    assert_frame_equal(result, expected)
+
+
+def test_map_numeric_values_missing():
+    mapping = {
+        (31, float("inf")): 31,
+        (16, 20): 20,
+    }
+
+    result = map_numeric_values(pd.Series([np.nan, 15, 16, 20, 30, 1000]), mapping)
+
+    np.testing.assert_array_equal(result, [np.nan, 15, 20, 20, 30, 31])
+
+
+def test_count_tests():
+    mapping = {"albumin": {(16, 20): 20, (21, float("inf")): 21}}
+
+    test_data = pd.DataFrame(
+        {
+            "albumin_code": ["a", "a", "b", "b", None],
+            "albumin_numeric_value": [17, 0, 0, 25, None],
+            "albumin_operator": ["=", None, "<", "~", None],
+        }
+    )
+
+    counts = combine_counts([count_tests(test_data, ["albumin"], mapping)] * 2)
+
+    assert_series_equal(
+        counts["code"].sort_index(),
+        pd.Series(
+            [4, 4],
+            index=pd.MultiIndex.from_tuples(
+                [("albumin", "a"), ("albumin", "b")], names=["test", "code"]
+            ),
+        ),
+    )
+    assert_series_equal(
+        counts["code_with_numeric_value"].sort_index(),
+        pd.Series(
+            [2, 4],
+            index=pd.MultiIndex.from_tuples(
+                [("albumin", "a"), ("albumin", "b")], names=["test", "code"]
+            ),
+        ),
+    )
+    assert_series_equal(
+        counts["operator"].sort_index(),
+        pd.Series(
+            [2, 2, 2],
+            index=pd.MultiIndex.from_tuples(
+                [("albumin", "<"), ("albumin", "="), ("albumin", "~")],
+                names=["test", "operator"],
+            ),
+        ),
+    )
+    assert_series_equal(
+        counts["numeric_value_operator"].sort_index(),
+        pd.Series(
+            [2, 2],
+            index=pd.MultiIndex.from_tuples(
+                [("albumin", 0, "<"), ("albumin", 20, "=")],
+                names=["test", "numeric_value_bin", "operator"],
+            ),
+        ),
+    )
+
+
+def test_count_file_first_seen_order(tmp_path):
+    mapping = {"albumin": {(16, 20): 20}}
+
+    partial_counts = []
+    for month, codes in enumerate([["a", "b", "b"], ["a", "a", "a", "c", "c"]]):
+        path = tmp_path / f"input_2020-0{month + 1}-01.csv.gz"
+        pd.DataFrame(
+            {
+                "patient_id": range(len(codes)),
+                "albumin_code": codes,
+                "albumin_numeric_value": 17,
+                "albumin_operator": "=",
+            }
+        ).to_csv(path, index=False)
+        partial_counts.append(count_file(path, ["albumin"], mapping))
+
+    # most common first in each extract, then in the order first seen, even
+    # though "a" is the most common code overall
+    counts = combine_counts(partial_counts)
+    assert list(counts["code"].index.get_level_values("code")) == ["b", "a", "c"]
+    assert list(counts["code"]) == [2, 4, 2]
@@ -0,0 +1,63 @@
+import numpy as np
+import pandas as pd
+
+from pandas._testing import assert_frame_equal
+from analysis.scripts.longitudinal import (
+    build_store,
+    latest_values,
+    read_static,
+    read_values,
+)
+from analysis.scripts.utilities import read_extract
+
+
+def test_longitudinal_store(tmp_path):
+    rng = np.random.default_rng(0)
+    paths = []
+    for date in ["2020-01-01", "2020-02-01", "2020-03-01"]:
+        n = 20
+        eGFR_numeric_value = rng.normal(60, 20, n)
+        eGFR_numeric_value[rng.random(n) < 0.5] = np.nan
+        path = tmp_path / f"input_{date}.csv.gz"
+        pd.DataFrame(
+            {
+                "patient_id": rng.choice(30, n, replace=False),
+                "sex": rng.choice(["F", "M"], n),
+                "age_band": rng.choice(["18-29", "30-39", None], n),
+                "eGFR": rng.integers(0, 2, n),
+                "eGFR_numeric_value": eGFR_numeric_value,
+            }
+        ).to_csv(path, index=False)
+        paths.append(path)
+
+    store_dir = build_store(paths, tmp_path / "longitudinal")
+    # a values file per month
+    assert len(list((store_dir / "values" / "eGFR").iterdir())) == len(paths)
+    columns = ["age_band", "eGFR", "eGFR_numeric_value"]
+
+    expected = pd.concat(
+        [
+            read_extract(path).assign(date=pd.Timestamp(path.name[6:16]))
+            for path in paths
+        ],
+        ignore_index=True,
+    )
+    result = read_values(columns, store_dir)
+    assert_frame_equal(
+        result[["patient_id", "date"] + columns],
+        expected[["patient_id", "date"] + columns].astype({"age_band": object}),
+        check_dtype=False,
+    )
+
+    latest = expected.drop_duplicates("patient_id", keep="last")
+    latest = latest.set_index("patient_id").sort_index()
+    assert_frame_equal(
+        latest_values(["sex"] + columns, store_dir),
+        latest[["sex"] + columns],
+        check_dtype=False,
+        check_categorical=False,
+    )
+
+    static = read_static(store_dir=store_dir).set_index("patient_id")
+    first_dates = expected.groupby("patient_id")["date"].min()
+    assert (static["first_date"] == first_dates).all()
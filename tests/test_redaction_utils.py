@@ -0,0 +1,268 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from pandas._testing import assert_frame_equal
+from analysis.scripts.redaction_utils import (
+    GROUP_LOW_COUNTS,
+    REMOVE_LOW_COUNTS,
+    SUPPRESS_LOW_COUNTS,
+    ZERO_LOW_COUNTS,
+    compute_deciles,
+    compute_deciles_wide,
+    get_quantiles,
+    group_low_values,
+    group_low_values_series,
+    redact,
+    redact_small_numbers,
+    redact_table_1,
+)
+from analysis.scripts.rounding import round_column
+
+
+def make_measure_table(n, seed):
+    rng = np.random.default_rng(seed)
+    value = rng.normal(10, 50, n)
+    value[rng.random(n) < 0.2] = np.nan
+    return pd.DataFrame(
+        {
+            "date": rng.choice(["2020-02-01", "2020-01-01", None, "2021-01-01"], n),
+            "value": value,
+        }
+    )
+
+
+def test_compute_deciles():
+    for seed in range(20):
+        df = make_measure_table(200, seed)
+        # a group with no values
+        df.loc[df["date"] == "2021-01-01", "value"] = np.nan
+
+        for has_outer_percentiles in (True, False):
+            quantiles = get_quantiles(has_outer_percentiles)
+            expected = (
+                df.groupby("date")["value"].quantile(pd.Series(quantiles)).reset_index()
+            )
+            expected["percentile"] = expected["level_1"].apply(lambda x: int(x * 100))
+
+            assert_frame_equal(
+                compute_deciles(df, "date", "value", has_outer_percentiles),
+                expected,
+                check_exact=True,
+            )
+
+
+def test_compute_deciles_wide():
+    df = make_measure_table(200, seed=0)
+
+    wide = compute_deciles_wide(df, "date", "value", has_outer_percentiles=False)
+    long = compute_deciles(df, "date", "value", has_outer_percentiles=False)
+
+    assert wide.columns.tolist() == [10, 20, 30, 40, 50, 60, 70, 80, 90]
+    assert_frame_equal(
+        wide.stack().reset_index(name="value"),
+        long[["date", "percentile", "value"]],
+        check_names=False,
+    )
+
+
+def reference_redact_small_numbers(
+    df, n, rounding_base, numerator, denominator, rate_column, date_column
+):
+    """The original, date by date implementation of redact_small_numbers"""
+
+    def suppress_column(column):
+        suppressed_count = column[column <= n].sum()
+
+        if suppressed_count != 0:
+            column[column <= n] = np.nan
+
+            while suppressed_count <= n:
+                suppressed_count += column.min()
+                column[column.idxmin()] = np.nan
+        return column
+
+    df_list = []
+    for d in df[date_column].unique():
+        df_subset = df.loc[df[date_column] == d, :]
+
+        for column in [numerator, denominator]:
+            df_subset = df_subset.assign(column=suppress_column(df_subset[column]))
+            df_subset[column] = round_column(df_subset[column], base=rounding_base)
+
+        df_subset.loc[
+            (df_subset[numerator].isna()) | (df_subset[denominator].isna()), rate_column
+        ] = np.nan
+        df_list.append(df_subset)
+
+    return pd.concat(df_list, axis=0)
+
+
+def make_counts_table(seed):
+    rng = np.random.default_rng(seed)
+    n = rng.integers(1, 30)
+    numerator = rng.choice([0, 1, 2, 3, 5, 7, 8, 10, 15, 40, 100, np.nan], n)
+    df = pd.DataFrame(
+        {
+            "date": rng.choice(["2020-01-01", "2020-02-01", "2020-03-01", None], n),
+            "numerator": numerator,
+            "denominator": numerator + rng.choice([0, 1, 3, 8, 20, 200], n),
+        }
+    )
+    if rng.random() < 0.5:
+        df = df.fillna(0).astype({"numerator": int, "denominator": int})
+    df["value"] = df["numerator"] / df["denominator"]
+    if rng.random() < 0.3:
+        # repeated index labels, as from concatenated single row frames
+        df.index = rng.integers(0, 3, n)
+    return df
+
+
+@pytest.mark.filterwarnings("ignore::pandas.errors.SettingWithCopyWarning")
+def test_redact_small_numbers():
+    for seed in range(200):
+        df = make_counts_table(seed)
+        args = (7, 5, "numerator", "denominator", "value", "date")
+        try:
+            expected = reference_redact_small_numbers(df.copy(), *args)
+        except ValueError:
+            # the reference can't reindex some tables with repeated labels
+            continue
+
+        assert_frame_equal(redact_small_numbers(df.copy(), *args), expected)
+
+
+def reference_group_low_values_series(series):
+    """The original, loop based implementation of group_low_values_series"""
+    suppressed_count = series[series <= 7].sum()
+
+    if suppressed_count == 0:
+        series = round_column(series, 5)
+
+    else:
+        series[series <= 7] = np.nan
+
+        while suppressed_count <= 7:
+            suppressed_count += series.min()
+            series[series.idxmin()] = np.nan
+
+        series = series[series.notnull()]
+
+        suppressed_count_series = pd.Series(suppressed_count, index=["Other"])
+        suppressed_count_series = round_column(suppressed_count_series, 5)
+
+        series = pd.concat([series, suppressed_count_series])
+
+    return series
+
+
+def reference_group_low_values(df, count_column, code_column, threshold, rounding_base):
+    """The original, loop based implementation of group_low_values"""
+    suppressed_count = df.loc[df[count_column] <= threshold, count_column].sum()
+    suppressed_df = df.loc[df[count_column] > threshold, count_column]
+
+    if (suppressed_count > 0) | (
+        (suppressed_count == 0) & (len(suppressed_df) != len(df))
+    ):
+        df.loc[df[count_column] <= threshold, count_column] = np.nan
+
+        if suppressed_count == 0:
+            df.loc[df[count_column] == 0, :] = np.nan
+
+        else:
+            while suppressed_count <= threshold:
+                suppressed_count += df[count_column].min()
+                df.loc[df[count_column].idxmin(), :] = np.nan
+
+        df = df.loc[df[count_column].notnull(), :]
+
+        if suppressed_count > threshold:
+            suppressed_count = {code_column: "Other", count_column: suppressed_count}
+            df = pd.concat([df, pd.DataFrame([suppressed_count])], ignore_index=True)
+
+    df[count_column] = round_column(df[count_column], rounding_base)
+
+    return df
+
+
+def make_code_counts(seed):
+    rng = np.random.default_rng(seed)
+    n = rng.integers(1, 20)
+    counts = rng.choice([0, 1, 2, 5, 7, 8, 9, 12, 40, 103], n)
+    if rng.random() < 0.2:
+        counts = counts.astype(float)
+        counts[rng.random(n) < 0.2] = np.nan
+    codes = rng.choice(1000, n, replace=False).astype(str)
+    return pd.Series(counts, index=pd.Index(codes, name="code"), name="count")
+
+
+@pytest.mark.filterwarnings("ignore::pandas.errors.SettingWithCopyWarning")
+def test_group_low_values():
+    for seed in range(200):
+        series = make_code_counts(seed)
+        pd.testing.assert_series_equal(
+            group_low_values_series(series.copy()),
+            reference_group_low_values_series(series.copy()),
+            check_names=False,
+        )
+
+        df = series.reset_index()
+        assert_frame_equal(
+            group_low_values(df.copy(), "count", "code", 7, 5),
+            reference_group_low_values(df.copy(), "count", "code", 7, 5),
+        )
+
+
+def test_redact_table_1():
+    for seed in range(50):
+        table = pd.concat(
+            {
+                condition: make_code_counts(seed * 3 + i).dropna()
+                for i, condition in enumerate(["sex", "age_band", "region"])
+            }
+        )
+        expected = pd.concat(
+            {
+                condition: reference_group_low_values_series(counts.droplevel(0))
+                for condition, counts in table.groupby(level=0)
+            }
+        )
+        pd.testing.assert_series_equal(
+            redact_table_1(table), expected, check_names=False, check_index_type=False
+        )
+
+
+@pytest.mark.filterwarnings("ignore::pandas.errors.SettingWithCopyWarning")
+def test_redact():
+    counts = pd.Series([1, 2, 40, 12, 9, 100], index=list("abcdef"))
+
+    redacted, audit = redact(counts, ZERO_LOW_COUNTS)
+    pd.testing.assert_series_equal(
+        redacted, pd.Series([0, 0, 40, 10, 10, 100], index=list("abcdef"))
+    )
+    assert audit["counts"] == 6
+    assert audit["suppressed"] == 2
+    assert (audit["total"], audit["redacted_total"]) == (164, 160)
+
+    redacted, audit = redact(counts, REMOVE_LOW_COUNTS)
+    assert redacted.index.tolist() == ["c", "d", "e", "f"]
+    assert audit["suppressed"] == 2
+
+    redacted, audit = redact(counts, GROUP_LOW_COUNTS)
+    pd.testing.assert_series_equal(
+        redacted, pd.Series([40, 10, 100, 10], index=["c", "d", "f", "Other"])
+    )
+    assert audit["suppressed"] == 3
+
+    df = make_counts_table(seed=1)
+    args = ("numerator", "denominator", "value", "date")
+    redacted, audit = redact(
+        df.copy(), SUPPRESS_LOW_COUNTS, ["numerator", "denominator"], "date", "value"
+    )
+    expected = redact_small_numbers(df.copy(), 7, 5, *args).drop(columns="column")
+    expected["value"] = expected["numerator"] / expected["denominator"]
+    assert_frame_equal(redacted, expected)
+    assert audit["suppressed"] == (
+        df[["numerator", "denominator"]].count().sum()
+        - expected[["numerator", "denominator"]].count().sum()
+    )
@@ -0,0 +1,36 @@
+import numpy as np
+import pandas as pd
+
+from analysis.scripts.rounding import drop_and_round, round_column
+
+
+def reference_round_column(column, base):
+    return column.apply(lambda x: base * round(x / base) if pd.notnull(x) else x)
+
+
+def test_round_column():
+    rng = np.random.default_rng(0)
+    # halves (2.5, 7.5, ...) round to even, as round() does
+    values = np.concatenate([np.arange(0, 100, 0.5), rng.integers(0, 10**6, 200)])
+
+    for dtype in ["int64", "float64", "float32"]:
+        column = pd.Series(values.astype(dtype), name="count")
+        pd.testing.assert_series_equal(
+            round_column(column, 5), reference_round_column(column, 5)
+        )
+
+    column = pd.Series(values).where(rng.random(len(values)) < 0.8)
+    pd.testing.assert_series_equal(
+        round_column(column, 5), reference_round_column(column, 5)
+    )
+
+
+def test_drop_and_round():
+    column = pd.Series([0, 3, 7, 8, 12, 13, np.nan], index=list("abcdefg"))
+    original = column.copy()
+
+    pd.testing.assert_series_equal(
+        drop_and_round(column),
+        pd.Series([0, 0, 0, 10, 10, 15, np.nan], index=list("abcdefg")),
+    )
+    pd.testing.assert_series_equal(column, original)
@@ -0,0 +1,28 @@
+from analysis.scripts.schema import get_extract_schema, get_variable_types
+
+
+def test_get_variable_types():
+    variable_types = get_variable_types("study_definition")
+
+    assert variable_types["at_risk"] == "binary_flag"
+    assert variable_types["eGFR_code"] == "category"
+    assert variable_types["eGFR_numeric_value"] == "numeric_value"
+    assert variable_types["eGFR_date"] == "date"
+    assert variable_types["ckd_primis_stage"] == "category"
+    assert variable_types["age"] == "int"
+
+    # variables defined within other variables aren't in the extract
+    assert "acr_numeric_value_history" not in variable_types
+
+
+def test_get_extract_schema():
+    dtype, parse_dates = get_extract_schema()
+
+    assert dtype["at_risk"] == "uint8"
+    assert dtype["ckd_primis_stage"] == "category"
+    assert dtype["eGFR_numeric_value"] == "float64"
+    assert "eGFR_date" in parse_dates
+
+    # joined variables can be missing
+    assert dtype["ukrr_2020"] == "float32"
+    assert dtype["ethnicity"] == "category"
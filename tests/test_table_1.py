@@ -0,0 +1,37 @@
+import numpy as np
+import pandas as pd
+
+from analysis.scripts.table_1 import categorise, create_table
+
+
+def test_create_table():
+    rng = np.random.default_rng(0)
+    n = 500
+    df = pd.DataFrame(
+        {
+            "sex": pd.Categorical(rng.choice(["F", "M"], n)),
+            "region": rng.choice(["East", "London", "missing", None], n),
+            "ethnicity": pd.Categorical(
+                rng.choice(["White", "Missing", "Black", None], n),
+                categories=["White", "Missing", "Black", "Other"],
+            ),
+        }
+    )
+    columns = list(df.columns)
+
+    expected = (
+        df.astype(object)
+        .fillna("Missing")
+        .replace("missing", "Missing")
+        .apply(lambda x: x.value_counts())
+        .T.stack()
+    )
+    expected = (5 * np.round(expected / 5)).astype(int)
+
+    for column in columns:
+        df[column] = categorise(df[column])
+    table = create_table(df, columns)
+
+    assert table.index.tolist() == expected.index.tolist()
+    assert table.tolist() == expected.tolist()
+    assert table.index.names == ["condition", "condition_value"]
@@ -0,0 +1,271 @@
+import os
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from pandas._testing import assert_frame_equal
+from analysis.scripts import utilities
+from analysis.scripts.utilities import (
+    cached_partial,
+    ckd_epi,
+    ckd_epi_series,
+    cockcroft_gault,
+    cockcroft_gault_series,
+    get_columnar_path,
+    get_module_dependencies,
+    histogram_counts,
+    iter_extract,
+    read_columnar,
+    read_extract,
+    read_measure,
+    sum_by_flag,
+    update_latest,
+    write_columnar,
+)
+
+
+def test_read_extract_columnar(tmp_path):
+    path = tmp_path / "input_2020-01-01.csv.gz"
+    pd.DataFrame(
+        {
+            "patient_id": [1, 2, 3],
+            "sex": ["M", "F", None],
+            "eGFR_code": [1001, None, 1002],
+            "eGFR_numeric_value": [50.5, 0, 30],
+        }
+    ).to_csv(path, index=False)
+
+    write_columnar(path)
+    assert get_columnar_path(path).exists()
+
+    columns = ["eGFR_code", "sex"]
+    assert_frame_equal(
+        read_extract(path, usecols=columns),
+        pd.read_csv(path, usecols=columns, dtype="category"),
+    )
+    assert read_columnar(path, columns=columns) is not None
+
+    # a copy with the same contents but a new modification time is up to date
+    os.utime(path, ns=(0, 0))
+    assert read_columnar(path, columns=columns) is not None
+
+
+def test_read_extract_stale_columnar(tmp_path):
+    path = tmp_path / "input_2020-01-01.csv.gz"
+    pd.DataFrame({"patient_id": [1, 2], "sex": ["M", "F"]}).to_csv(path, index=False)
+    write_columnar(path)
+
+    pd.DataFrame({"patient_id": [1, 2, 3], "sex": ["M", "F", "F"]}).to_csv(
+        path, index=False
+    )
+
+    assert read_columnar(path) is None
+    assert len(read_extract(path)) == 3
+
+
+def test_iter_extract(tmp_path):
+    path = tmp_path / "input_2020-01-01.csv.gz"
+    pd.DataFrame(
+        {
+            "patient_id": range(10),
+            "at_risk": [0, 1] * 5,
+            "eGFR_numeric_value": range(10),
+        }
+    ).to_csv(path, index=False)
+
+    for columnar in [False, True]:
+        if columnar:
+            write_columnar(path)
+
+        chunks = list(
+            iter_extract(
+                path,
+                usecols=["at_risk", "eGFR_numeric_value"],
+                where=lambda df: df["at_risk"] == 1,
+                chunksize=3,
+            )
+        )
+
+        result = pd.concat(chunks)
+        assert list(result.columns) == ["at_risk", "eGFR_numeric_value"]
+        assert list(result["eGFR_numeric_value"]) == [1, 3, 5, 7, 9]
+
+
+def test_sum_by_flag(tmp_path):
+    path = tmp_path / "input_2021-03-01.csv.gz"
+    pd.DataFrame(
+        {
+            "patient_id": range(8),
+            "at_risk": [1, 1, 1, 1, 1, 1, 0, 0],
+            "ukrr_2019": [1, 1, 1, 1, 1, 1, 1, 1],
+            "ukrr_2020": [0, 0, 1, 1, 1, np.nan, 1, 0],
+            "eGFR": [1, 0, 1, 1, 0, 1, 1, 1],
+        }
+    ).to_csv(path, index=False)
+
+    result = sum_by_flag(
+        path,
+        ["eGFR"],
+        {"2020": "ukrr_2019", "2021": "ukrr_2020"},
+        where_column="at_risk",
+    )
+
+    assert list(result.index) == [0, 1]
+    assert list(result["eGFR"]) == [1, 2]
+    assert list(result["count"]) == [2, 3]
+
+    # an empty extract sums to 0
+    empty_path = tmp_path / "input_2021-04-01.csv.gz"
+    pd.read_csv(path).iloc[:0].to_csv(empty_path, index=False)
+    for columnar in [False, True]:
+        if columnar:
+            write_columnar(empty_path)
+        result = sum_by_flag(empty_path, ["eGFR"], {"2021": "ukrr_2020"})
+        assert list(result.index) == [0, 1]
+        assert result.to_numpy().tolist() == [[0, 0], [0, 0]]
+
+
+def test_read_measure(tmp_path):
+    path = tmp_path / "measure_eGFR_biochemical_stage_population_rate.csv"
+    pd.DataFrame(
+        {
+            "ckd_egfr_category": ["G1", "G3a", None],
+            "single_egfr": [0, 1, 1],
+            "eGFR": [1, 2, 3],
+            "population": [4, 5, 6],
+            "value": [0.25, 0.4, 0.5],
+            "date": ["2020-01-01"] * 3,
+        }
+    ).to_csv(path, index=False)
+
+    df = read_measure("eGFR_biochemical_stage_population_rate", tmp_path)
+    assert df["date"].dtype == "datetime64[ns]"
+    assert list(df["ckd_egfr_category"].cat.categories) == ["G1", "G3a"]
+    assert df["single_egfr"].dtype == np.int64
+
+
+def count_rows(path):
+    return len(read_extract(path))
+
+
+def test_cached_partial(tmp_path, monkeypatch):
+    path = tmp_path / "input_cached.csv.gz"
+    store_dir = tmp_path / "partials"
+    pd.DataFrame({"patient_id": [1, 2]}).to_csv(path, index=False)
+
+    assert cached_partial(path, func=count_rows, store_dir=store_dir) == 2
+    assert len(list(store_dir.iterdir())) == 1
+
+    # the stored partial is reused while the extract is unchanged
+    pd.to_pickle(5, next(store_dir.iterdir()))
+    assert cached_partial(path, func=count_rows, store_dir=store_dir) == 5
+
+    # and replaced when it changes
+    pd.DataFrame({"patient_id": [1, 2, 3]}).to_csv(path, index=False)
+    assert cached_partial(path, func=count_rows, store_dir=store_dir) == 3
+    assert len(list(store_dir.iterdir())) == 1
+
+    # a new partials version isn't keyed like the stored partial
+    pd.to_pickle(5, next(store_dir.iterdir()))
+    monkeypatch.setattr(utilities, "PARTIALS_VERSION", utilities.PARTIALS_VERSION + 1)
+    assert cached_partial(path, func=count_rows, store_dir=store_dir) == 3
+
+
+def test_get_module_dependencies():
+    scripts_dir = Path(utilities.__file__).parent
+    dependencies = get_module_dependencies(scripts_dir / "combine_operators.py")
+
+    # the modules combine_operators imports, directly or through utilities, and
+    # not the scripts it doesn't
+    assert [path.name for path in dependencies] == [
+        "combine_operators.py",
+        "redaction_utils.py",
+        "rounding.py",
+        "schema.py",
+        "utilities.py",
+        "variables.py",
+    ]
+
+
+def make_calculator_inputs(n, seed):
+    rng = np.random.default_rng(seed)
+    dates = pd.Series(pd.date_range("2021-01-01", periods=730)).sample(
+        n, replace=True, random_state=seed, ignore_index=True
+    )
+    creatinine = rng.choice([0.0, np.nan, -1.2, 0.1, 0.2, 1.5, 80.0], n)
+    return pd.DataFrame(
+        {
+            "sex": rng.choice(["F", "M", "U"], n),
+            "age": rng.integers(18, 100, n),
+            "weight": rng.uniform(40, 120, n).round(1),
+            "weight_date": dates.sample(frac=1, random_state=seed, ignore_index=True),
+            "creatinine": np.where(
+                rng.random(n) < 0.5, creatinine, rng.uniform(-5, 200, n)
+            ),
+            "creatinine_date": dates.where(rng.random(n) < 0.9),
+        }
+    )
+
+
+def assert_equal_calculated(series, expected):
+    for value, expected_value in zip(series.tolist(), expected):
+        if expected_value is None or expected_value != expected_value:
+            assert pd.isna(value)
+        else:
+            assert value == expected_value
+
+
+def test_calculator_series():
+    df = make_calculator_inputs(2000, seed=0)
+    rows = df.astype(object).to_dict("records")
+
+    assert_equal_calculated(
+        cockcroft_gault_series(*[df[column] for column in df], "2022-01-01"),
+        [cockcroft_gault(*row.values(), "2022-01-01") for row in rows],
+    )
+
+    df = df.drop(["weight", "weight_date"], axis=1)
+    rows = df.astype(object).to_dict("records")
+    assert_equal_calculated(
+        ckd_epi_series(*[df[column] for column in df], "2022-01-01"),
+        [ckd_epi(*row.values(), "2022-01-01") for row in rows],
+    )
+
+
+def test_update_latest():
+    rng = np.random.default_rng(0)
+    frames = [
+        pd.DataFrame(
+            {
+                "patient_id": rng.choice(20, 10, replace=False),
+                "sex": rng.choice(["F", "M"], 10),
+                "region": rng.choice(["East", "London", "missing"], 10),
+            }
+        )
+        for _ in range(5)
+    ]
+
+    expected = pd.concat(frames).drop_duplicates("patient_id", keep="last")
+
+    latest = None
+    for df in frames:
+        latest = update_latest(latest, df)
+    assert_frame_equal(
+        latest.sort_values("patient_id").reset_index(drop=True),
+        expected.sort_values("patient_id").reset_index(drop=True),
+    )
+
+
+def test_histogram_counts():
+    rng = np.random.default_rng(0)
+    values = rng.normal(50, 40, 1000).astype("float32")
+    values[rng.random(1000) < 0.1] = np.nan
+
+    counts = histogram_counts(values[:300], 0, 100, 5) + histogram_counts(
+        values[300:], 0, 100, 5
+    )
+    expected, _ = np.histogram(
+        values[(values >= 0) & (values <= 100)], bins=np.arange(0, 105, 5)
+    )
+    assert counts.tolist() == expected.tolist()